@@ -1,238 +1,3482 @@
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
 from datetime import datetime
-import filecmp
+import difflib
+import errno
+import functools
+import hashlib
+import heapq
+import json
+import mmap
 import os
-# from pathlib import Path
 import pathlib
-import random
+import re
+import selectors
+import shlex
 import shutil
+import socket
+from stat import S_ISDIR, S_ISREG
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
-# def wit_rm(*args):
-#     subfolder = 'staging_area'
-#     backup_dir = check_backup_dir(subfolder)
-#     files = os.listdir(backup_dir)
-#     print(files)
-#     for arg in args:
-#         arg = arg.absolute().resolve()
-#         if arg in files:
-#             file = pathlib.Path(arg)
-#             if os.path.isfile(arg):
-#                 file.unlink()
-#             elif os.path.isdir(arg):
-#                 file.rmdir()
-
-
-# class TrackedFile(object):
-#     def __init__(self):
-#         self._cached_stamp = 0
-#         self.filename = '/path/to/file'
-#
-#     def check_change(self):
-#         stamp = os.stat(self.filename).st_mtime
-#         if stamp != self._cached_stamp:
-#             self._cached_stamp = stamp
-
-def copy_file_or_dir(src, dst):
-    """A function that takes a source path and destination path, checks if the source
-    is a file or a directory and copies it to the destination"""
-    if os.path.isfile(src):
-        shutil.copy2(src, dst)
-    elif os.path.isdir(src):
-        dst = dst / src
-        shutil.copytree(src, dst)
-
-def check_backup_dir(subdir=None):
-    """A function that takes a subdirectory name, checks if a '.wit' backup directory
-    exists and returns a path object with the subdirectory. If no subdirectory name
-    is passed the function retruns the '.wit' directory. If the '.wit' directory does
-    not exist up the directory tree it raises a FileNotFoundError"""
-    main_backup_dir = '.wit'
-    backup_dir = pathlib.Path(os.getcwd())
-    while backup_dir.parent != backup_dir and main_backup_dir not in os.listdir(backup_dir):
-        backup_dir = backup_dir.parent
-    backup_home_dir = backup_dir / main_backup_dir
-    if backup_dir == backup_dir.parent and not backup_home_dir.exists():
-        raise FileNotFoundError('No backup folder found.')
-    if subdir is None:
-        return backup_home_dir
-    return backup_home_dir / subdir
-
-
-def determine_parent():
-    parent = 'None'
-    main_backup_dir = check_backup_dir()
-    if (main_backup_dir / 'references.txt').exists():
-        with open(main_backup_dir / 'references.txt', 'r') as references:
-            parent = references.readlines()[0][5:45]
-    return parent
-
-
-def make_meta_data(backup_dir, commit_id, message, parent):
-    """A function that takes a path, a randomly generated file id,
-    and a message, and generates a metadata txt file."""
-    now = datetime.now()
+BLOCK_SIZE = 1024 * 1024
+INDEX_SIGNATURE = b'WIDX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('>4sII')
+INDEX_ENTRY = struct.Struct('>QQQ20sH')
+
+GRAPH_SIGNATURE = b'WCGR'
+GRAPH_VERSION = 1
+GRAPH_HEADER = struct.Struct('>4sI')
+GRAPH_RECORD = struct.Struct('>20sIIIq')
+NO_PARENT = 0xFFFFFFFF
+FROM_FIRST = 1
+FROM_SECOND = 2
+STALE = 4
+BLOOM_SIGNATURE = b'WBLM'
+BLOOM_VERSION = 1
+BLOOM_HEADER = struct.Struct('>4sI')
+BLOOM_RECORD = struct.Struct('>20sH')
+BLOOM_BITS_PER_PATH = 10
+BLOOM_HASHES = 7
+BLOOM_MAX_PATHS = 512
+LOCK_TIMEOUT = 10
+LOCK_RETRY_DELAY = 0.01
+FICLONE = 0x40049409
+MATERIALIZE_ORDER = ['hardlink', 'reflink', 'copy_file_range', 'copy']
+UNSUPPORTED_METHODS = set()
+PACK_SIGNATURE = b'WPCK'
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct('>4sII')
+PACK_ENTRY = struct.Struct('>B20sQQ')
+PACK_FULL = 0
+PACK_DELTA = 1
+PACK_CHUNKS = 2
+PACK_INDEX_SIGNATURE = b'WPIX'
+PACK_INDEX_VERSION = 1
+PACK_INDEX_HEADER = struct.Struct('>4sII')
+PACK_FANOUT = struct.Struct('>256I')
+PACK_OFFSET = struct.Struct('>Q')
+PACK_WINDOW = 10
+PACK_DEPTH = 50
+PACK_INDEXES = {}
+PACK_MAPS = {}
+DELTA_BASE_CACHES = {}
+DELTA_BASE_CACHE_SIZE = 96 * 1024 * 1024
+DELTA_COPY = struct.Struct('>BQQ')
+DELTA_INSERT = struct.Struct('>BQ')
+DELTA_COPY_OP = 0
+DELTA_INSERT_OP = 1
+CHUNK_THRESHOLD = 64 * 1024 * 1024
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_WINDOW = 32
+CHUNK_TABLE = bytes(hashlib.sha1(bytes([value])).digest()[0] for value in range(256))
+CHUNK_WINDOW_SUMS = sum(1 << (16 * position) for position in range(CHUNK_WINDOW))
+CHUNK_SCAN_SIZE = 256 * 1024
+CHUNK_MASK = 0xFFF
+DIFF_CONTEXT = 3
+DIFF_MAX_EDITS = 1000
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                | IN_ONLYDIR | IN_DONT_FOLLOW)
+INOTIFY_EVENT = struct.Struct('iIII')
+FSMONITOR_SOCKET = 'fsmonitor.sock'
+FSMONITOR_TIMEOUT = 1
+IGNORE_MATCHERS = {}
+FILE_CACHES = {}
+UNSYNCED_FILES = set()
+TREE_IDS = {}
+TRACER = None
+TRACE_IO = '/proc/self/io'
+TRACE_IO_FIELDS = ('syscr', 'syscw', 'rchar', 'wchar')
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+IndexEntry = collections.namedtuple('IndexEntry', ['size', 'mtime_ns', 'inode', 'object_id'])
+CommitGraph = collections.namedtuple('CommitGraph', ['ids', 'positions', 'parents', 'generations', 'times'])
+Changes = collections.namedtuple('Changes', ['added', 'modified', 'deleted'])
+Status = collections.namedtuple('Status', ['head', 'staged', 'unstaged', 'untracked'])
+Commit = collections.namedtuple('Commit', ['id', 'parents', 'date', 'message', 'tree'])
+MergeResult = collections.namedtuple('MergeResult', ['commit_id', 'conflicts'])
+
+
+class WitError(Exception):
+    """An error that stops a wit command, such as a head that moved while merging."""
+
+
+class UnsavedChangesError(WitError):
+    """An error raised when a command would overwrite changes that are not committed.
+    The status dictionary that shows them is kept in the status attribute."""
+
+    def __init__(self, status):
+        super().__init__('Unsaved changes detected, please check your work and commit changes.')
+        self.status = status
+
+
+class Tracer(object):
+    """A recorder of timed spans that are written as Chrome trace-event JSON, for
+    chrome://tracing or Perfetto. Spans nest per thread. Every span records its wall
+    time, the counters added while it was open, such as the bytes copied and the
+    files touched, and the read and write syscalls and characters of the process
+    from /proc/self/io where it exists. The tracer's own reads of /proc/self/io
+    are subtracted from them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.io_reads = 0
+        self.io_read_chars = 0
+        try:
+            self.io_fd = os.open(TRACE_IO, os.O_RDONLY)
+        except OSError:
+            self.io_fd = None
+
+    def read_io(self):
+        """Returns the syscall counters of the process, less the tracer's own reads."""
+        if self.io_fd is None:
+            return {}
+        with self.lock:
+            data = os.pread(self.io_fd, 4096, 0)
+            counters = {}
+            for line in data.decode().splitlines():
+                key, _separator, value = line.partition(': ')
+                if key in TRACE_IO_FIELDS:
+                    counters[key] = int(value)
+            counters['syscr'] -= self.io_reads
+            counters['rchar'] -= self.io_read_chars
+            self.io_reads += 1
+            self.io_read_chars += len(data)
+        return counters
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        """Records the work done inside the with block as a span."""
+        stack = self.local.__dict__.setdefault('stack', [])
+        counters = collections.Counter()
+        stack.append(counters)
+        io_before = self.read_io()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            io_after = self.read_io()
+            stack.pop()
+            for key, value in io_after.items():
+                counters[key] = value - io_before[key]
+            self.events.append({'name': name, 'cat': 'wit', 'ph': 'X', 'pid': os.getpid(),
+                                'tid': threading.get_native_id(), 'ts': (start - self.start) * 1e6,
+                                'dur': (end - start) * 1e6, 'args': {**args, **counters}})
+
+    def count(self, name, amount):
+        """Adds an amount to a counter of every span open in this thread."""
+        for counters in getattr(self.local, 'stack', ()):
+            counters[name] += amount
+
+    def write(self):
+        """Writes the spans recorded so far to the trace file."""
+        with open(self.path, 'w') as trace_file:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def start_tracing(path):
+    """A function that records trace spans from now on and writes them to the path
+    as Chrome trace-event JSON when the process exits."""
+    global TRACER
+    TRACER = Tracer(path)
+    atexit.register(TRACER.write)
+
+
+def trace_span(name, **args):
+    """A function that returns a context manager recording the work done inside it
+    as a span with the arguments passed to it when tracing is on, and a context
+    manager that does nothing otherwise."""
+    if TRACER is None:
+        return contextlib.nullcontext()
+    return TRACER.span(name, args)
+
+
+def trace_count(name, amount=1):
+    """A function that adds an amount to a counter of the open spans, such as
+    'bytes_copied' or 'files_touched', when tracing is on."""
+    if TRACER is not None:
+        TRACER.count(name, amount)
+
+
+def traced(function):
+    """A decorator that records every call of a function as a span named after it
+    when tracing is on, such as 'read_ref' or 'Transaction.commit'. Tracing is
+    checked on each call, so it costs a single global lookup otherwise."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if TRACER is None:
+            return function(*args, **kwargs)
+        with TRACER.span(function.__qualname__, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+if os.environ.get('WIT_TRACE'):
+    start_tracing(os.environ['WIT_TRACE'])
+
+
+class Repository(object):
+    """A wit repository: the '.wit' backup directory and the working directory
+    holding it. The backup directory is discovered once and the repository is
+    passed to every command, so no command searches for it again.
+    Its methods are the Python API of wit: they run the commands in process and
+    return Status, Commit and MergeResult records instead of printing. The parsed
+    index, commit graph, Bloom filters and packs are cached between calls and
+    checked against their files, so commands run by other processes are seen.
+    Paths passed to the methods are relative to the repository root."""
+
+    def __init__(self, main_backup_dir):
+        self.main_backup_dir = pathlib.Path(main_backup_dir).absolute()
+        self.root = self.main_backup_dir.parent
+        if is_old_layout(self.main_backup_dir):
+            migrate_repository(self.main_backup_dir)
+
+    @classmethod
+    @traced
+    def discover(cls, start=None):
+        """Finds the '.wit' backup directory. The WIT_DIR environment variable names
+        it directly. Otherwise the directories from the start directory (the cwd by
+        default) upwards are checked with a single stat each, without entering the
+        directories listed in WIT_CEILING_DIRECTORIES (separated by os.pathsep),
+        which keeps slow network mounts above a project from being searched.
+        Raises a FileNotFoundError if no backup directory is found."""
+        wit_dir = os.environ.get('WIT_DIR')
+        if wit_dir:
+            if not os.path.isdir(wit_dir):
+                raise FileNotFoundError(f'WIT_DIR {wit_dir} is not a directory.')
+            return cls(wit_dir)
+        ceilings = {os.path.abspath(ceiling)
+                    for ceiling in os.environ.get('WIT_CEILING_DIRECTORIES', '').split(os.pathsep) if ceiling}
+        directory = os.path.abspath(start or os.getcwd())
+        while True:
+            if os.path.isdir(os.path.join(directory, '.wit')):
+                return cls(os.path.join(directory, '.wit'))
+            parent = os.path.dirname(directory)
+            if parent == directory or parent in ceilings:
+                raise FileNotFoundError('No backup folder found.')
+            directory = parent
+
+    @classmethod
+    def open(cls, path=None):
+        """Opens the repository holding the path, the cwd by default."""
+        return cls.discover(path)
+
+    def add(self, path=None, jobs=None):
+        """Stages a file or the files of a directory, or every change of the working
+        tree without a path."""
+        add(self, None if path is None else self.root / path, jobs)
+
+    def commit(self, message):
+        """Commits the staging area and returns the new Commit."""
+        return read_commit(self.main_backup_dir, commit(self, message))
+
+    def status(self):
+        """Returns the Status of the head, the staging area and the working tree."""
+        return read_status(self)
+
+    def checkout(self, name):
+        """Checks out a branch or a commit id and returns the Commit of the head.
+        Raises an UnsavedChangesError if there are changes that are not committed."""
+        return read_commit(self.main_backup_dir, checkout(self, name))
+
+    def branch(self, name):
+        """Creates a branch at the head and returns the Commit it points at."""
+        return read_commit(self.main_backup_dir, branch(self, name))
+
+    def merge(self, name):
+        """Merges a branch or a commit id into the head and returns a MergeResult with
+        the commit id of the new head, or None and the conflicted paths when the merge
+        is left for the next commit."""
+        conflicts = merge(self, name)
+        return MergeResult(None if conflicts else read_head(self.main_backup_dir), conflicts)
+
+    def log(self, revision='HEAD', paths=(), first_parent=False, since=None, limit=None):
+        """Yields the Commit records reachable from the revision, newest first, only
+        those that changed the paths if any are passed."""
+        paths = [self.root / path for path in paths]
+        for metadata in log(self, revision, paths, first_parent, since, limit):
+            yield make_commit_record(metadata)
+
+    def diff(self, old=None, new=None, paths=(), cached=False):
+        """Yields the lines of a unified diff, as 'wit diff' prints them."""
+        return diff(self, old, new, [self.root / path for path in paths], cached)
+
+
+def write_file_atomically(path, content):
+    """A function that writes bytes to a file through a temp file that is flushed to
+    disk and renamed over it, so readers see either the old content or the new one."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_fd, temp_file = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(temp_fd, 'wb') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+
+def sync_directory(directory):
+    """A function that flushes a directory to disk so renames inside it survive a
+    crash. Platforms that can not open directories are skipped."""
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def sync_file(path):
+    """A function that flushes a file that is already written to disk."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_new_files():
+    """A function that flushes the object store and metadata files written by this
+    process since the last call to disk, along with the directories holding them and
+    their parents, so no ref or index written afterwards can point at a file a crash
+    would lose. The files are flushed together on a pool of threads, which lets the
+    filesystem commit them in a few journal writes instead of one per file."""
+    paths = list(UNSYNCED_FILES)
+    if not paths:
+        return
+    UNSYNCED_FILES.difference_update(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+        list(executor.map(sync_file, paths))
+    directories = {os.path.dirname(path) for path in paths}
+    for directory in directories | {os.path.dirname(directory) for directory in directories}:
+        sync_directory(directory)
+
+
+class Transaction(object):
+    """A set of updates to files in the '.wit' directory that are applied together.
+    A file taking part is locked by creating '<name>.lock' exclusively, and its new
+    content is written into the lock file itself. When the transaction ends without
+    an error all written lock files are flushed to disk in one batch and then renamed
+    over their files, so a crash leaves every file either old or new and never
+    truncated. Files that were only locked are released untouched. Each file has its
+    own lock, so processes working on different refs do not wait for each other."""
+
+    def __init__(self, main_backup_dir):
+        self.main_backup_dir = main_backup_dir
+        self.locks = {}
+        self.written = []
+        self.deleted = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def lock(self, name, wait=True):
+        """Locks a file of the '.wit' directory, waiting up to LOCK_TIMEOUT seconds
+        for another process to release it. If wait is False returns False at once
+        when the file is locked by someone else."""
+        if name in self.locks:
+            return True
+        lock_path = self.main_backup_dir / f'{name}.lock'
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                self.locks[name] = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+                return True
+            except FileExistsError:
+                if not wait:
+                    return False
+                if time.monotonic() > deadline:
+                    self.rollback()
+                    raise FileExistsError(f'{lock_path} exists, another wit process is using the repository. '
+                                          f'If no wit process is running remove the file.')
+                time.sleep(LOCK_RETRY_DELAY)
+
+    def write(self, name, content):
+        """Locks a file and writes its new content, a string or bytes, into the lock file."""
+        self.lock(name)
+        if isinstance(content, str):
+            content = content.encode()
+        view = memoryview(content)
+        while view:
+            view = view[os.write(self.locks[name], view):]
+        self.written.append(name)
+
+    def delete(self, name):
+        """Locks a file and deletes it when the transaction is committed."""
+        self.lock(name)
+        self.deleted.append(name)
+
+    @traced
+    def commit(self):
+        """Flushes the new objects and metadata files of this process and the written
+        lock files, renames the lock files over their files, deletes the files marked
+        for deletion and releases the other locks. Every file a ref or the index may
+        point at is on disk before they are renamed into place."""
+        sync_new_files()
+        for name in self.written:
+            os.fsync(self.locks[name])
+        for descriptor in self.locks.values():
+            os.close(descriptor)
+        directories = set()
+        for name in self.written:
+            target = self.main_backup_dir / name
+            os.replace(self.main_backup_dir / f'{name}.lock', target)
+            directories.add(target.parent)
+        for name in self.deleted:
+            target = self.main_backup_dir / name
+            if target.exists():
+                target.unlink()
+            directories.add(target.parent)
+        for name in self.locks:
+            if name not in self.written:
+                os.unlink(self.main_backup_dir / f'{name}.lock')
+        self.locks = {}
+        for directory in directories:
+            sync_directory(directory)
+
+    def rollback(self):
+        """Releases every lock without changing any file."""
+        for name, descriptor in self.locks.items():
+            os.close(descriptor)
+            os.unlink(self.main_backup_dir / f'{name}.lock')
+        self.locks = {}
+
+
+class FSMonitor(object):
+    """A daemon that watches the working tree with inotify and answers, on a Unix
+    socket in the '.wit' directory, which paths changed since a token it handed out
+    earlier. Every event gets a sequence number and the last one of every path is
+    kept, so a query is answered without touching the filesystem. A token is the
+    daemon's session and a sequence number, so tokens of an earlier daemon, or
+    tokens from before the kernel dropped events, are answered with '*', which
+    means the whole working tree must be examined."""
+
+    def __init__(self, repository):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not supported on this platform.')
+        self.root = repository.root
+        self.main_backup_dir = repository.main_backup_dir
+        self.session = f'{os.getpid()}-{time.time_ns()}'
+        self.sequence = 0
+        self.lost_sequence = 0
+        self.changed = {}
+        self.watches = {}
+        self.running = True
+        self.descriptor = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watch_tree('')
+
+    def watch_tree(self, path):
+        """Watches a directory and the directories under it, and marks the files found
+        in them as changed, since they may have been written before the watch."""
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            watch = self.libc.inotify_add_watch(self.descriptor, os.fsencode(self.root / directory), INOTIFY_MASK)
+            if watch < 0:
+                if ctypes.get_errno() == errno.ENOSPC:
+                    self.lost_sequence = self.sequence + 1
+                continue
+            self.watches[watch] = directory
+            try:
+                with os.scandir(self.root / directory) as entries:
+                    for entry in entries:
+                        entry_path = f'{directory}/{entry.name}' if directory else entry.name
+                        if entry_path == '.wit':
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry_path)
+                        elif path:
+                            self.mark(entry_path)
+            except FileNotFoundError:
+                continue
+
+    def unwatch_tree(self, path):
+        """Stops watching a directory that was moved away and the directories under it."""
+        for watch, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(f'{path}/'):
+                self.libc.inotify_rm_watch(self.descriptor, watch)
+                del self.watches[watch]
+
+    def mark(self, path):
+        """Records a change of a path."""
+        self.sequence += 1
+        self.changed[path] = self.sequence
+
+    def read_events(self):
+        """Reads every event queued by the kernel. A write is queued before the system
+        call returns, so once the queue is drained every change made before a query
+        is known."""
+        while True:
+            try:
+                data = os.read(self.descriptor, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                watch, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self.handle_event(watch, mask, name)
+
+    def handle_event(self, watch, mask, name):
+        """Records the path of an event and follows the directories that are created,
+        moved in or moved away."""
+        if mask & IN_Q_OVERFLOW:
+            self.sequence += 1
+            self.lost_sequence = self.sequence
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(watch, None)
+            return
+        directory = self.watches.get(watch)
+        if directory is None or not name:
+            return
+        path = f'{directory}/{name}' if directory else name
+        if path == '.wit':
+            return
+        self.mark(path)
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unwatch_tree(path)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+
+    def answer(self, connection):
+        """Answers a query: the new token, then '*' or the paths changed since the
+        token sent by the client. A client sending 'quit' stops the daemon."""
+        connection.settimeout(FSMONITOR_TIMEOUT)
+        with connection, connection.makefile('rb') as request:
+            token = request.readline().decode().rstrip('\n')
+            if token == 'quit':
+                self.running = False
+                return
+            self.read_events()
+            session, _separator, sequence = token.rpartition(':')
+            lines = [f'{self.session}:{self.sequence}']
+            if session != self.session or not sequence.isdigit() or int(sequence) < self.lost_sequence:
+                lines.append('*')
+            else:
+                lines.extend(path for path, changed in self.changed.items() if changed > int(sequence))
+            connection.sendall(''.join(f'{line}\n' for line in lines).encode())
+
+    def run(self):
+        """Serves queries until asked to quit."""
+        socket_path = self.main_backup_dir / FSMONITOR_SOCKET
+        if socket_path.exists():
+            socket_path.unlink()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server, selectors.DefaultSelector() as selector:
+            server.bind(str(socket_path))
+            server.listen()
+            selector.register(server, selectors.EVENT_READ)
+            selector.register(self.descriptor, selectors.EVENT_READ)
+            try:
+                while self.running:
+                    for key, _events in selector.select():
+                        if key.fileobj is server:
+                            try:
+                                self.answer(server.accept()[0])
+                            except OSError:
+                                pass
+                        else:
+                            self.read_events()
+            finally:
+                os.close(self.descriptor)
+                if socket_path.exists():
+                    socket_path.unlink()
+
+
+def object_path(main_backup_dir, object_id):
+    """A function that takes the main backup directory and an object id and returns
+    the path of the object in the object store. Objects are spread over sub-directories
+    named after the first two characters of their id."""
+    return main_backup_dir / 'objects' / object_id[:2] / object_id[2:]
+
+
+def hash_file(path):
+    """A function that returns the sha1 hex digest of a file's content. The file is
+    read in blocks so its size does not affect memory use."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_cache_key(path):
+    """A function that returns the inode, mtime_ns and size of a file, which change
+    whenever the file is replaced by a rename or appended to, or None if the file
+    does not exist."""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def read_cached_file(path, parse):
+    """A function that returns the content of a file as parsed by the parse function,
+    or None if the file does not exist. The parsed content is kept in FILE_CACHES and
+    only parsed again once the file's stat data changed, so a long-running process
+    such as 'wit --batch' sees the changes made by other processes without reading
+    unchanged files again."""
+    key = file_cache_key(path)
+    if key is None:
+        FILE_CACHES.pop(path, None)
+        return None
+    cached = FILE_CACHES.get(path)
+    if cached is None or cached[0] != key:
+        with open(path, 'rb') as cached_file:
+            cached = (key, parse(cached_file.read()))
+        FILE_CACHES[path] = cached
+    return cached[1]
+
+
+def read_config(main_backup_dir):
+    """A function that returns the 'key=value' lines of the repository's config
+    file as a dictionary."""
+    config = {}
+    if (main_backup_dir / 'config.txt').exists():
+        with open(main_backup_dir / 'config.txt', 'r') as config_file:
+            for line in config_file:
+                key, _separator, value = line.rstrip('\n').partition('=')
+                config[key] = value
+    return config
+
+
+def set_config(repository, key, value):
+    """A function that sets a key in the repository's config file."""
+    main_backup_dir = repository.main_backup_dir
+    config = read_config(main_backup_dir)
+    config[key] = value
+    with open(main_backup_dir / 'config.txt', 'w') as config_file:
+        config_file.writelines(f'{name}={config[name]}\n' for name in config)
+
+
+def materialize_methods(main_backup_dir, allow_hardlink=True):
+    """A function that returns the copy methods to try, fastest first, according to
+    the 'materialize' config key. The key may be 'auto' (the default, which tries
+    reflink, then copy_file_range, then a plain copy) or the name of the preferred
+    method, in which case the slower methods are kept as fallbacks. Hardlinks are
+    only used when asked for, because the linked file shares the object's inode."""
+    method = read_config(main_backup_dir).get('materialize', 'auto')
+    if method == 'auto':
+        method = 'reflink'
+    if method not in MATERIALIZE_ORDER:
+        raise ValueError(f'Unknown materialize method: {method}')
+    methods = MATERIALIZE_ORDER[MATERIALIZE_ORDER.index(method):]
+    if not allow_hardlink and 'hardlink' in methods:
+        methods.remove('hardlink')
+    return methods
+
+
+def hardlink_file(src, dst):
+    """A function that replaces the destination with a hardlink to the source."""
+    os.unlink(dst)
+    os.link(src, dst)
+
+
+def reflink_file(src, dst):
+    """A function that makes the destination a copy-on-write clone of the source
+    with the FICLONE ioctl (btrfs, XFS)."""
+    if fcntl is None:
+        raise OSError('Reflinks are not supported on this platform.')
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def copy_file_range_file(src, dst):
+    """A function that copies a file inside the kernel with os.copy_file_range."""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError('copy_file_range is not supported on this platform.')
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+MATERIALIZE_FUNCTIONS = {'hardlink': hardlink_file,
+                         'reflink': reflink_file,
+                         'copy_file_range': copy_file_range_file,
+                         'copy': shutil.copyfile}
+
+
+def copy_with_methods(src, dst, methods):
+    """A function that copies a file over an existing destination file with the first
+    of the methods passed to it that the filesystem supports. A method that fails is
+    not tried again by this process."""
+    for method in methods:
+        if method in UNSUPPORTED_METHODS:
+            continue
+        try:
+            MATERIALIZE_FUNCTIONS[method](src, dst)
+            if method != 'hardlink':
+                os.chmod(dst, 0o666 & ~UMASK)
+            return
+        except OSError:
+            if method == 'copy':
+                raise
+            UNSUPPORTED_METHODS.add(method)
+
+
+def materialize_file(src, dst, methods):
+    """A function that copies a file with copy_with_methods. The destination is
+    replaced through a temp file, so a destination that is a hardlink to an object
+    is never written through."""
+    temp_fd, temp_file = tempfile.mkstemp(dir=dst.parent, suffix='.tmp')
+    os.close(temp_fd)
+    try:
+        copy_with_methods(src, temp_file, methods)
+        os.replace(temp_file, dst)
+        if TRACER is not None:
+            trace_count('files_touched')
+            trace_count('bytes_copied', os.stat(dst).st_size)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+
+
+@traced
+def store_blob(main_backup_dir, path, methods=None, chunk_threshold=None):
+    """A function that stores a file in the object store under the hash of its content
+    and returns the object id. The file is copied into a temp file of the object store
+    first and the copy is hashed and renamed to its id, so the stored content is
+    always the content that was hashed, even if the file changes while it is stored.
+    A copy whose content is already stored is deleted. Stored objects are read-only,
+    so a hardlinked working file can not be edited in place by mistake. Files of
+    chunk_threshold bytes or more (the 'chunk_threshold' config key by default) are
+    stored in chunks by store_chunked_file."""
+    if chunk_threshold is None:
+        chunk_threshold = int(read_config(main_backup_dir).get('chunk_threshold', CHUNK_THRESHOLD))
+    if os.stat(path).st_size >= chunk_threshold:
+        return store_chunked_file(main_backup_dir, path)
+    if methods is None:
+        methods = materialize_methods(main_backup_dir, allow_hardlink=False)
+    temp_fd, temp_file = tempfile.mkstemp(dir=main_backup_dir / 'objects', suffix='.tmp')
+    os.close(temp_fd)
+    temp_file = pathlib.Path(temp_file)
+    try:
+        copy_with_methods(path, temp_file, methods)
+        object_id = hash_file(temp_file)
+        if TRACER is not None:
+            trace_count('files_hashed')
+            trace_count('bytes_copied', os.stat(temp_file).st_size)
+        if not has_object(main_backup_dir, object_id):
+            destination = object_path(main_backup_dir, object_id)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(temp_file, 0o444)
+            os.replace(temp_file, destination)
+            UNSYNCED_FILES.add(destination)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+    return object_id
+
+
+def find_chunk_boundary(data):
+    """A function that returns the end of the first chunk of the data passed to it,
+    or None if there is no boundary in its first CHUNK_MAX_SIZE bytes. A boundary may
+    fall after any byte: it is a position whose preceding CHUNK_WINDOW bytes, mapped
+    through CHUNK_TABLE, sum to a multiple of 256 and have a crc32 with the
+    CHUNK_MASK bits clear. The window sums of a whole block are computed at C speed
+    by one big integer multiplication: every mapped byte takes a 16-bit field and
+    multiplying by CHUNK_WINDOW_SUMS adds each field to itself and the fields of the
+    CHUNK_WINDOW - 1 bytes before it. Boundaries only depend on the bytes around
+    them, so an edit moves the boundaries near it and the chunks after them are the
+    same as before."""
+    start = CHUNK_MIN_SIZE - CHUNK_WINDOW
+    end = min(len(data), CHUNK_MAX_SIZE)
+    while start <= end - CHUNK_WINDOW:
+        mapped = data[start:min(start + CHUNK_SCAN_SIZE + CHUNK_WINDOW - 1, end)].translate(CHUNK_TABLE)
+        fields = bytearray(2 * len(mapped))
+        fields[1::2] = mapped
+        sums = (int.from_bytes(fields, 'big') * CHUNK_WINDOW_SUMS).to_bytes(
+            2 * (len(mapped) + CHUNK_WINDOW - 1), 'big')
+        low_bytes = sums[2 * CHUNK_WINDOW - 1::2]
+        count = len(mapped) - CHUNK_WINDOW + 1
+        position = low_bytes.find(0, 0, count)
+        while position != -1:
+            boundary = start + position + CHUNK_WINDOW
+            if zlib.crc32(data[boundary - CHUNK_WINDOW:boundary]) & CHUNK_MASK == 0:
+                return boundary
+            position = low_bytes.find(0, position + 1, count)
+        start += count
+    return None
+
+
+def iter_chunks(file):
+    """A function that reads a file in blocks and yields its content-defined chunks.
+    At most CHUNK_MAX_SIZE bytes and one block are held in memory, whatever the size
+    of the file."""
+    buffer = bytearray()
+    end_of_file = False
+    while True:
+        while not end_of_file and len(buffer) < CHUNK_MAX_SIZE:
+            block = file.read(BLOCK_SIZE)
+            end_of_file = not block
+            buffer += block
+        if not buffer:
+            return
+        end = find_chunk_boundary(buffer) or min(len(buffer), CHUNK_MAX_SIZE)
+        yield bytes(buffer[:end])
+        del buffer[:end]
+
+
+def chunk_manifest_path(main_backup_dir, object_id):
+    """A function that returns the path of the chunk manifest of a chunked file."""
+    path = object_path(main_backup_dir, object_id)
+    return path.with_name(f'{path.name}.chunks')
+
+
+def store_chunked_file(main_backup_dir, path):
+    """A function that stores a large file as content-defined chunks and returns its
+    object id, which is the hash of the whole content like that of any other blob.
+    The file is read once, every chunk is stored as an object of its own, so chunks
+    shared with earlier versions of the file are not stored again, and a manifest
+    of '<chunk id> <size>' lines is stored next to where the blob would be."""
+    sha = hashlib.sha1()
+    lines = []
+    with open(path, 'rb') as file:
+        for chunk in iter_chunks(file):
+            sha.update(chunk)
+            lines.append(f'{store_object(main_backup_dir, chunk)} {len(chunk)}\n')
+    object_id = sha.hexdigest()
+    if not has_object(main_backup_dir, object_id):
+        write_object_file(chunk_manifest_path(main_backup_dir, object_id), ''.join(lines).encode())
+    return object_id
+
+
+def read_chunk_manifest(main_backup_dir, object_id):
+    """A function that returns the list of (chunk id, size) pairs of a chunked file,
+    or None if the object is not chunked."""
+    try:
+        with open(chunk_manifest_path(main_backup_dir, object_id), 'rb') as manifest_file:
+            manifest = manifest_file.read()
+    except FileNotFoundError:
+        try:
+            pack_data, offset = find_packed_entry(main_backup_dir, object_id)
+        except FileNotFoundError:
+            return None
+        kind, _base_id, _size, length = PACK_ENTRY.unpack_from(pack_data, offset)
+        if kind != PACK_CHUNKS:
+            return None
+        manifest = zlib.decompress(pack_data[offset + PACK_ENTRY.size:offset + PACK_ENTRY.size + length])
+    chunks = []
+    for line in manifest.decode().splitlines():
+        chunk_id, size = line.split(' ')
+        chunks.append((chunk_id, int(size)))
+    return chunks
+
+
+def iter_chunk_views(main_backup_dir, chunks):
+    """A function that yields the content of the chunks of a manifest one at a time."""
+    for chunk_id, _size in chunks:
+        yield read_object_view(main_backup_dir, chunk_id)
+
+
+def store_object(main_backup_dir, data):
+    """A function that stores a bytes object in the object store and returns its id."""
+    object_id = hashlib.sha1(data).hexdigest()
+    if not has_object(main_backup_dir, object_id):
+        write_object_file(object_path(main_backup_dir, object_id), data)
+    return object_id
+
+
+def write_object_file(destination, content):
+    """A function that writes a new read-only file of the object store through a temp
+    file of its own in the same directory. Threads storing the same content at once
+    each write their own temp file and the last rename wins."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    temp_fd, temp_file = tempfile.mkstemp(dir=destination.parent, suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as object_file:
+            object_file.write(content)
+        os.chmod(temp_file, 0o444)
+        os.replace(temp_file, destination)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+    UNSYNCED_FILES.add(destination)
+    trace_count('objects_written')
+
+
+def read_object(main_backup_dir, object_id):
+    """A function that returns the content of an object in the object store. Loose
+    objects are read first and the pack files are searched for the others. Chunked
+    files are joined back together, use read_chunk_manifest to stream them instead."""
+    try:
+        with open(object_path(main_backup_dir, object_id), 'rb') as object_file:
+            return object_file.read()
+    except FileNotFoundError:
+        chunks = read_chunk_manifest(main_backup_dir, object_id)
+        if chunks is not None:
+            return b''.join(iter_chunk_views(main_backup_dir, chunks))
+        return read_packed_object(main_backup_dir, object_id)
+
+
+def read_object_view(main_backup_dir, object_id):
+    """A function that returns the content of an object as a memoryview without
+    copying it. Loose objects are mapped into memory and packed objects are served
+    from the bytes they were inflated to."""
+    try:
+        with open(object_path(main_backup_dir, object_id), 'rb') as object_file:
+            if os.fstat(object_file.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(object_file.fileno(), 0, access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+        return memoryview(read_object(main_backup_dir, object_id))
+
+
+class DeltaBaseCache(object):
+    """A least recently used cache of the objects inflated from pack files that
+    deltas were applied to. Objects sharing a delta chain are read one after the
+    other by log, diff and checkout, so keeping their bases saves inflating the
+    whole chain again. The total size of the cached objects stays under the budget."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.objects = collections.OrderedDict()
+
+    def get(self, object_id):
+        """Returns a cached object and marks it as recently used, or None."""
+        data = self.objects.get(object_id)
+        if data is not None:
+            self.objects.move_to_end(object_id)
+        return data
+
+    def put(self, object_id, data):
+        """Caches an object, evicting the least recently used ones over the budget."""
+        if object_id in self.objects or len(data) > self.budget:
+            return
+        self.objects[object_id] = data
+        self.size += len(data)
+        while self.size > self.budget:
+            _evicted_id, evicted = self.objects.popitem(last=False)
+            self.size -= len(evicted)
+
+
+def delta_base_cache(main_backup_dir):
+    """A function that returns the delta base cache of the repository, created on
+    first use with the byte budget of the 'delta_base_cache' config key."""
+    if main_backup_dir not in DELTA_BASE_CACHES:
+        budget = int(read_config(main_backup_dir).get('delta_base_cache', DELTA_BASE_CACHE_SIZE))
+        DELTA_BASE_CACHES[main_backup_dir] = DeltaBaseCache(budget)
+    return DELTA_BASE_CACHES[main_backup_dir]
+
+
+def map_file(path):
+    """A function that maps a whole file into memory for reading."""
+    with open(path, 'rb') as mapped_file:
+        return mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def has_object(main_backup_dir, object_id):
+    """A function that checks if an object is stored, loose, chunked or in a pack file."""
+    if object_path(main_backup_dir, object_id).exists() or chunk_manifest_path(main_backup_dir, object_id).exists():
+        return True
+    raw_id = bytes.fromhex(object_id)
+    return any(find_in_pack_index(index_data, raw_id) is not None
+               for _pack_path, index_data in read_pack_indexes(main_backup_dir))
+
+
+def read_pack_indexes(main_backup_dir):
+    """A function that returns a list of (pack path, index data) pairs, one for every
+    pack file of the object store. Pack files never change once written, so their
+    indexes are mapped into memory once per process and kept in PACK_INDEXES."""
+    pack_directory = main_backup_dir / 'objects' / 'pack'
+    if not pack_directory.exists():
+        return []
+    indexes = []
+    for index_path in sorted(pack_directory.glob('pack-*.idx')):
+        if index_path not in PACK_INDEXES:
+            index_data = map_file(index_path)
+            signature, version, _count = PACK_INDEX_HEADER.unpack_from(index_data)
+            if signature != PACK_INDEX_SIGNATURE or version != PACK_INDEX_VERSION:
+                raise ValueError(f'{index_path} is not a pack index.')
+            PACK_INDEXES[index_path] = index_data
+        indexes.append((index_path.with_suffix('.pack'), PACK_INDEXES[index_path]))
+    return indexes
+
+
+def find_in_pack_index(index_data, raw_id):
+    """A function that returns the offset of an object in a pack file, or None if
+    the pack does not hold it. The index holds a fanout table counting the ids up
+    to every first byte, the sorted ids and their offsets, so the search is a
+    binary search over the ids sharing the object's first byte."""
+    _signature, _version, count = PACK_INDEX_HEADER.unpack_from(index_data)
+    fanout = PACK_FANOUT.unpack_from(index_data, PACK_INDEX_HEADER.size)
+    ids_start = PACK_INDEX_HEADER.size + PACK_FANOUT.size
+    low = fanout[raw_id[0] - 1] if raw_id[0] else 0
+    high = fanout[raw_id[0]]
+    while low < high:
+        middle = (low + high) // 2
+        candidate = index_data[ids_start + middle * 20:ids_start + middle * 20 + 20]
+        if candidate == raw_id:
+            return PACK_OFFSET.unpack_from(index_data, ids_start + count * 20 + middle * PACK_OFFSET.size)[0]
+        if candidate < raw_id:
+            low = middle + 1
+        else:
+            high = middle
+    return None
+
+
+def find_packed_entry(main_backup_dir, object_id):
+    """A function that returns the mapped pack file holding an object and the
+    offset of the object's entry in it. Pack files are mapped once per process
+    and kept in PACK_MAPS."""
+    raw_id = bytes.fromhex(object_id)
+    for pack_path, index_data in read_pack_indexes(main_backup_dir):
+        offset = find_in_pack_index(index_data, raw_id)
+        if offset is not None:
+            if pack_path not in PACK_MAPS:
+                PACK_MAPS[pack_path] = map_file(pack_path)
+            return PACK_MAPS[pack_path], offset
+    raise FileNotFoundError(f'Object {object_id} not found.')
+
+
+def read_packed_object(main_backup_dir, object_id):
+    """A function that returns the content of an object stored in a pack file.
+    The delta chain is followed down to a whole object or to a base found in the
+    delta base cache, and the deltas are then applied on the way back up. Every
+    base on the way is cached for the next objects of the chain."""
+    cache = delta_base_cache(main_backup_dir)
+    data = cache.get(object_id)
+    if data is not None:
+        return data
+    chain = []
+    current_id = object_id
+    while data is None:
+        pack_data, offset = find_packed_entry(main_backup_dir, current_id)
+        kind, base_id, size, length = PACK_ENTRY.unpack_from(pack_data, offset)
+        if kind == PACK_CHUNKS:
+            return b''.join(iter_chunk_views(main_backup_dir, read_chunk_manifest(main_backup_dir, current_id)))
+        with memoryview(pack_data)[offset + PACK_ENTRY.size:offset + PACK_ENTRY.size + length] as compressed:
+            chain.append((current_id, kind, size, zlib.decompress(compressed)))
+        if kind == PACK_FULL:
+            break
+        current_id = base_id.hex()
+        data = cache.get(current_id)
+    for chain_id, kind, size, inflated in reversed(chain):
+        data = inflated if kind == PACK_FULL else apply_delta(data, inflated)
+        if len(data) != size:
+            raise ValueError(f'Object {chain_id} is corrupt.')
+        if chain_id != object_id:
+            cache.put(chain_id, data)
+    return data
+
+
+def index_lines(data):
+    """A function that returns a dictionary of every line of the data passed to it
+    and the offset of its first occurrence, used to find copies when making deltas."""
+    lines = {}
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        lines.setdefault(line, offset)
+        offset += len(line)
+    return lines
+
+
+def make_delta(base, base_lines, target):
+    """A function that encodes the target as a list of instructions that copy ranges
+    of the base and insert new bytes. Runs of target lines found in the base, through
+    the base_lines index of index_lines, become a single copy. Lines shorter than a
+    copy instruction are inserted unless they extend a copy."""
+    instructions = []
+    inserted = []
+    copy_offset = copy_length = 0
+    for line in target.splitlines(keepends=True):
+        copy_end = copy_offset + copy_length
+        if copy_length and base[copy_end:copy_end + len(line)] == line:
+            copy_length += len(line)
+            continue
+        offset = base_lines.get(line) if len(line) > DELTA_COPY.size else None
+        if copy_length:
+            instructions.append(DELTA_COPY.pack(DELTA_COPY_OP, copy_offset, copy_length))
+            copy_length = 0
+        if offset is None:
+            inserted.append(line)
+            continue
+        if inserted:
+            data = b''.join(inserted)
+            instructions.append(DELTA_INSERT.pack(DELTA_INSERT_OP, len(data)) + data)
+            inserted = []
+        copy_offset, copy_length = offset, len(line)
+    if copy_length:
+        instructions.append(DELTA_COPY.pack(DELTA_COPY_OP, copy_offset, copy_length))
+    if inserted:
+        data = b''.join(inserted)
+        instructions.append(DELTA_INSERT.pack(DELTA_INSERT_OP, len(data)) + data)
+    return b''.join(instructions)
+
+
+def apply_delta(base, delta):
+    """A function that rebuilds an object from its base and the instructions made
+    by make_delta."""
+    base = memoryview(base)
+    result = bytearray()
+    position = 0
+    while position < len(delta):
+        if delta[position] == DELTA_COPY_OP:
+            _op, offset, length = DELTA_COPY.unpack_from(delta, position)
+            result += base[offset:offset + length]
+            position += DELTA_COPY.size
+        else:
+            _op, length = DELTA_INSERT.unpack_from(delta, position)
+            position += DELTA_INSERT.size
+            result += delta[position:position + length]
+            position += length
+    return bytes(result)
+
+
+def write_tree(main_backup_dir, node):
+    """A function that takes a nested dictionary of names, where directories are
+    dictionaries and files are blob ids, stores a tree object for every directory
+    and returns the id of the top tree. Each line of a tree object is
+    '<kind> <object id> <name>'."""
+    lines = []
+    for name in sorted(node):
+        child = node[name]
+        if isinstance(child, dict):
+            lines.append(f'tree {write_tree(main_backup_dir, child)} {name}\n')
+        else:
+            lines.append(f'blob {child} {name}\n')
+    return store_object(main_backup_dir, ''.join(lines).encode())
+
+
+@traced
+def write_index_tree(main_backup_dir, index):
+    """A function that turns the flat paths of the index into tree objects and
+    returns the id of the top tree."""
+    root = {}
+    for path, entry in index.items():
+        *dirs, name = path.split('/')
+        node = root
+        for directory in dirs:
+            node = node.setdefault(directory, {})
+        node[name] = entry.object_id
+    return write_tree(main_backup_dir, root)
+
+
+def read_tree(main_backup_dir, tree_id):
+    """A function that takes a tree id and returns a list of (kind, object id, name)
+    tuples, one for every entry of the tree."""
+    entries = []
+    for line in read_object(main_backup_dir, tree_id).decode().splitlines():
+        kind, object_id, name = line.split(' ', 2)
+        entries.append((kind, object_id, name))
+    return entries
+
+
+def flatten_tree(main_backup_dir, tree_id, prefix=''):
+    """A function that takes a tree id and returns a dictionary of the full paths
+    of the files in the tree and their blob ids."""
+    files = {}
+    for kind, object_id, name in read_tree(main_backup_dir, tree_id):
+        path = f'{prefix}{name}'
+        if kind == 'tree':
+            files.update(flatten_tree(main_backup_dir, object_id, f'{path}/'))
+        else:
+            files[path] = object_id
+    return files
+
+
+def diff_tree_entries(main_backup_dir, old_tree_id, new_tree_id, prefix=''):
+    """A generator that compares two trees, either of which may be None for an empty
+    tree, and yields a (path, old blob id, new blob id) tuple for every file that
+    differs, with None for the side the file is missing from. Subtrees with the same
+    id are identical and are skipped without being read, so the cost follows the size
+    of the difference and not the size of the trees."""
+    if old_tree_id == new_tree_id:
+        return
+    old_entries = {}
+    if old_tree_id is not None:
+        old_entries = {name: (kind, object_id) for kind, object_id, name in read_tree(main_backup_dir, old_tree_id)}
+    new_entries = {}
+    if new_tree_id is not None:
+        new_entries = {name: (kind, object_id) for kind, object_id, name in read_tree(main_backup_dir, new_tree_id)}
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        old_kind, old_id = old_entries.get(name, (None, None))
+        new_kind, new_id = new_entries.get(name, (None, None))
+        if (old_kind, old_id) == (new_kind, new_id):
+            continue
+        path = f'{prefix}{name}'
+        if old_kind == 'tree' or new_kind == 'tree':
+            yield from diff_tree_entries(main_backup_dir, old_id if old_kind == 'tree' else None,
+                                         new_id if new_kind == 'tree' else None, f'{path}/')
+        if old_kind == 'blob' or new_kind == 'blob':
+            yield (path, old_id if old_kind == 'blob' else None, new_id if new_kind == 'blob' else None)
+
+
+@traced
+def compare_trees(main_backup_dir, old_tree_id, new_tree_id, prefix=''):
+    """A function that compares two trees, either of which may be None for an empty
+    tree, and returns a dictionary of the added paths and their blob ids, a dictionary
+    of the modified paths and their new blob ids and a list of the deleted paths.
+    Identical subtrees are skipped, see diff_tree_entries."""
+    added = {}
+    modified = {}
+    deleted = []
+    for path, old_id, new_id in diff_tree_entries(main_backup_dir, old_tree_id, new_tree_id, prefix):
+        if old_id is None:
+            added[path] = new_id
+        elif new_id is None:
+            deleted.append(path)
+        else:
+            modified[path] = new_id
+    return added, modified, deleted
+
+
+@traced
+def remove_files(root, paths):
+    """A function that deletes the files at the paths passed to it under the root
+    directory, along with the directories left empty by their removal."""
+    for path in paths:
+        file_path = root / path
+        if file_path.exists():
+            file_path.unlink()
+            trace_count('files_touched')
+        directory = file_path.parent
+        while directory != root and directory.exists() and not any(directory.iterdir()):
+            directory.rmdir()
+            directory = directory.parent
+
+
+def write_working_file(path, blocks):
+    """A function that replaces a working file with the bytes or memoryviews passed
+    to it through a temp file, for objects that are chunked or only stored in a pack
+    file. The blocks may be a generator, so a chunked file is never held in memory."""
+    temp_fd, temp_file = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as file:
+            for block in blocks:
+                file.write(block)
+            size = file.tell()
+        os.chmod(temp_file, 0o666 & ~UMASK)
+        os.replace(temp_file, path)
+        trace_count('files_touched')
+        trace_count('bytes_copied', size)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+
+
+@traced
+def restore_files(main_backup_dir, root, files):
+    """A function that takes a dictionary of paths and blob ids, writes every blob to
+    its path under the root directory and returns index entries holding the stat data
+    of the written files. Loose objects are copied with the materialize methods,
+    chunked files are written chunk by chunk and packed objects are inflated and
+    written."""
+    methods = materialize_methods(main_backup_dir)
+    index = {}
+    for path, object_id in files.items():
+        destination = root / path
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        source = object_path(main_backup_dir, object_id)
+        chunks = None if source.exists() else read_chunk_manifest(main_backup_dir, object_id)
+        if source.exists():
+            materialize_file(source, destination, methods)
+        elif chunks is not None:
+            write_working_file(destination, iter_chunk_views(main_backup_dir, chunks))
+        else:
+            write_working_file(destination, [read_object_view(main_backup_dir, object_id)])
+        index[path] = make_index_entry(object_id, os.stat(destination))
+    return index
+
+
+def walk_files(root, prefix='', ignore=None):
+    """A function that walks a directory tree in a single pass with os.scandir and
+    yields the path relative to the root and the stat data of every file in it.
+    The prefix is the path of the walked directory relative to the root, ending
+    with '/'. The '.wit' backup directory is never entered, and neither are the
+    directories matched by the ignore matcher, if one is passed, whose ignored
+    files are skipped too."""
+    pending = [prefix]
+    while pending:
+        prefix = pending.pop()
+        with os.scandir(os.path.join(root, prefix)) as entries:
+            for entry in entries:
+                path = f'{prefix}{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != '.wit' and (ignore is None or not ignore.is_ignored(path, True)):
+                        pending.append(f'{path}/')
+                elif entry.is_file(follow_symlinks=False):
+                    if ignore is None or not ignore.is_ignored(path, False):
+                        yield path, entry.stat(follow_symlinks=False)
+
+
+def glob_to_regex(pattern):
+    """A function that translates a gitignore glob to a regular expression. '*' and
+    '?' do not match '/', '**' matches across directories and '[...]' is a class."""
+    parts = []
+    position = 0
+    while position < len(pattern):
+        if pattern.startswith('**/', position):
+            parts.append('(?:.*/)?')
+            position += 3
+        elif pattern.startswith('**', position):
+            parts.append('.*')
+            position += 2
+        elif pattern[position] == '*':
+            parts.append('[^/]*')
+            position += 1
+        elif pattern[position] == '?':
+            parts.append('[^/]')
+            position += 1
+        elif pattern[position] == '[' and pattern.find(']', position + 2) != -1:
+            end = pattern.find(']', position + 2)
+            content = pattern[position + 1:end].replace('\\', '\\\\')
+            if content.startswith('!'):
+                content = f'^{content[1:]}'
+            parts.append(f'[{content}]')
+            position = end + 1
+        elif pattern[position] == '\\' and position + 1 < len(pattern):
+            parts.append(re.escape(pattern[position + 1]))
+            position += 2
+        else:
+            parts.append(re.escape(pattern[position]))
+            position += 1
+    return ''.join(parts)
+
+
+class IgnoreMatcher(object):
+    """The patterns of a '.witignore' file, with the syntax of gitignore: '#' starts
+    a comment, '!' negates a pattern, a trailing '/' only matches directories and a
+    pattern holding a '/' is matched from the root, others match a name at any level.
+    Patterns are compiled once: names and paths without wildcards go into sets and
+    all the others into one combined regex, so matching a path costs two lookups and
+    one regex match however many patterns there are. Only files with negated patterns,
+    where the last matching pattern decides, are matched pattern by pattern."""
+
+    def __init__(self, lines):
+        self.rules = []
+        self.names = set()
+        self.paths = set()
+        self.directory_names = set()
+        self.directory_paths = set()
+        file_patterns = []
+        directory_patterns = []
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.endswith('\\ '):
+                line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated or line.startswith(('\\#', '\\!')):
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if not line:
+                continue
+            regex = glob_to_regex(line) if anchored else f'(?:.*/)?{glob_to_regex(line)}'
+            self.rules.append((negated, directory_only, re.compile(regex, re.DOTALL)))
+            if negated:
+                continue
+            if not any(character in line for character in '*?[\\'):
+                names = self.paths if anchored else self.names
+                if directory_only:
+                    names = self.directory_paths if anchored else self.directory_names
+                names.add(line)
+                continue
+            directory_patterns.append(regex)
+            if not directory_only:
+                file_patterns.append(regex)
+        self.ordered = any(negated for negated, _directory_only, _regex in self.rules)
+        self.file_regex = re.compile('|'.join(f'(?:{regex})' for regex in file_patterns), re.DOTALL) \
+            if file_patterns else None
+        self.directory_regex = re.compile('|'.join(f'(?:{regex})' for regex in directory_patterns), re.DOTALL) \
+            if directory_patterns else None
+
+    def is_ignored(self, path, is_directory):
+        """Checks if a path relative to the root is ignored. The directories holding
+        it are not checked, since walks never enter ignored directories."""
+        if self.ordered:
+            for negated, directory_only, regex in reversed(self.rules):
+                if (is_directory or not directory_only) and regex.fullmatch(path):
+                    return not negated
+            return False
+        name = path.rpartition('/')[2]
+        if name in self.names or path in self.paths:
+            return True
+        if is_directory and (name in self.directory_names or path in self.directory_paths):
+            return True
+        regex = self.directory_regex if is_directory else self.file_regex
+        return regex is not None and regex.fullmatch(path) is not None
+
+    def is_path_ignored(self, path):
+        """Checks if a file is ignored, by itself or by one of its directories."""
+        parts = path.split('/')
+        for end in range(1, len(parts)):
+            if self.is_ignored('/'.join(parts[:end]), True):
+                return True
+        return self.is_ignored(path, False)
+
+
+def read_ignore_matcher(root):
+    """A function that returns the compiled matcher of the root's '.witignore' file.
+    Matchers are compiled once per version of the file and kept in IGNORE_MATCHERS."""
+    ignore_path = os.path.join(root, '.witignore')
+    try:
+        stat_result = os.stat(ignore_path)
+    except FileNotFoundError:
+        return IgnoreMatcher([])
+    key = (ignore_path, stat_result.st_mtime_ns, stat_result.st_size)
+    if key not in IGNORE_MATCHERS:
+        with open(ignore_path, 'r') as ignore_file:
+            IGNORE_MATCHERS[key] = IgnoreMatcher(ignore_file.readlines())
+    return IGNORE_MATCHERS[key]
+
+
+def walk_working_tree(root, index, prefix=''):
+    """A function that returns a dictionary of the working files under the prefix and
+    their stat data. Ignored directories are not entered and ignored files are left
+    out, but tracked files are never ignored: the tracked files the walk skipped are
+    looked up one by one, with None for those that are missing or are no longer
+    regular files, such as a tracked file replaced by a directory."""
+    files = dict(walk_files(root, prefix, read_ignore_matcher(root)))
+    for path in index:
+        if path.startswith(prefix) and path not in files:
+            files[path] = lstat_regular_file(os.path.join(root, path))
+    return files
+
+
+def lstat_regular_file(path):
+    """A function that returns the stat data of a regular file, without following
+    symlinks, or None if the path is missing or is not a regular file."""
+    try:
+        stat_result = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return stat_result if S_ISREG(stat_result.st_mode) else None
+
+
+def compare_files(old_files, new_files):
+    """A function that takes two dictionaries of paths and blob ids and returns
+    sorted lists of the added, modified and deleted paths."""
+    added = sorted(path for path in new_files if path not in old_files)
+    modified = sorted(path for path, object_id in new_files.items()
+                      if path in old_files and old_files[path] != object_id)
+    deleted = sorted(path for path in old_files if path not in new_files)
+    return added, modified, deleted
+
+
+def classify_working_file(root, path, stat_result, entry, index_time):
+    """A function that compares a working file, with stat_result None if it is missing,
+    to its index entry, None if it is not tracked. Returns 'modified', 'deleted',
+    'untracked', 'refreshed' for a file whose content matches the entry but whose stat
+    data does not, or None for a clean file. Files are only hashed when their stat
+    data differs from the entry."""
+    if entry is None:
+        return None if stat_result is None else 'untracked'
+    if stat_result is None:
+        return 'deleted'
+    if is_entry_clean(entry, stat_result, index_time):
+        return None
+    if hash_file(root / path) != entry.object_id:
+        return 'modified'
+    return 'refreshed'
+
+
+def expand_dirty_paths(root, known, paths, ignore):
+    """A function that returns the files to examine for the changed paths reported
+    by the fsmonitor daemon, with their stat data or None if they are missing. A
+    path that is a directory, or held known files (tracked or reported by the last
+    comparison), stands for every file under it. Ignored directories are not walked."""
+    known = sorted(known)
+    files = {}
+    for path in paths:
+        try:
+            stat_result = os.lstat(root / path)
+        except (FileNotFoundError, NotADirectoryError):
+            stat_result = None
+        if stat_result is None or not S_ISDIR(stat_result.st_mode):
+            files[path] = stat_result if stat_result is not None and S_ISREG(stat_result.st_mode) else None
+        else:
+            files[path] = None
+            if not ignore.is_path_ignored(path):
+                files.update(walk_files(root, f'{path}/', ignore))
+        position = bisect.bisect_left(known, f'{path}/')
+        while position < len(known) and known[position].startswith(f'{path}/'):
+            files.setdefault(known[position], None)
+            position += 1
+    return files
+
+
+@traced
+def compare_index_to_working_tree(main_backup_dir, index):
+    """A function that compares the working tree to the index. Working files are only
+    hashed again when their stat data differs from the index, and entries found
+    unchanged that way are refreshed in the index, unless another process holds the
+    index lock. Untracked files matched by '.witignore' are left out and ignored
+    directories are not entered. Without an fsmonitor daemon the working tree is
+    walked once. With one, the result of the last comparison is kept with the
+    daemon's token, and only the paths the daemon reports as changed since then and
+    the paths whose index entries changed since then are examined again. The kept
+    index is compared byte for byte and only parsed when it differs. Returns sorted
+    lists of the modified, deleted and untracked paths."""
+    index_time = index_mtime_ns(main_backup_dir)
+    root = main_backup_dir.parent
+    state = read_fsmonitor_state(main_backup_dir)
+    answer = query_fsmonitor(main_backup_dir, state[0] if state else '')
+    changes = {'modified': set(), 'deleted': set(), 'untracked': set()}
+    refreshed = {}
+    index_data = pack_index(index)
+    ignore = read_ignore_matcher(root)
+    keep_state = answer is not None
+    if answer is not None and answer[1] is not None and state is not None and '.witignore' not in answer[1]:
+        token, old_index_data, changes['modified'], changes['deleted'], changes['untracked'] = state
+        dirty = set(answer[1])
+        if old_index_data != index_data:
+            old_index = parse_index(old_index_data)
+            dirty.update(path for path in old_index.keys() | index.keys() if old_index.get(path) != index.get(path))
+        elif not dirty and token == answer[0]:
+            keep_state = False
+        files = expand_dirty_paths(root, set(index).union(*changes.values()), dirty, ignore)
+        files = {path: stat_result for path, stat_result in files.items()
+                 if stat_result is None or path in index or not ignore.is_path_ignored(path)}
+        for paths in changes.values():
+            paths.difference_update(files)
+    else:
+        files = walk_working_tree(root, index)
+    for path, stat_result in files.items():
+        entry = index.get(path)
+        change = classify_working_file(root, path, stat_result, entry, index_time)
+        if change == 'refreshed':
+            refreshed[path] = make_index_entry(entry.object_id, stat_result)
+        elif change is not None:
+            changes[change].add(path)
+    if refreshed:
+        with Transaction(main_backup_dir) as transaction:
+            if transaction.lock('index', wait=False):
+                current_index = read_index(main_backup_dir)
+                for path, entry in refreshed.items():
+                    current_entry = current_index.get(path)
+                    if current_entry is not None and current_entry.object_id == entry.object_id:
+                        current_index[path] = entry
+                write_index(transaction, current_index)
+    if keep_state:
+        write_fsmonitor_state(main_backup_dir, answer[0], index_data, changes)
+    return sorted(changes['modified']), sorted(changes['deleted']), sorted(changes['untracked'])
+
+
+def read_fsmonitor_state(main_backup_dir):
+    """A function that returns the fsmonitor token of the last comparison of the
+    working tree to the index, the bytes of the index it was made against and the
+    sets of modified, deleted and untracked paths found, or None if there is no such
+    state. The state file holds the token, the number of change lines, one
+    '<M, D or U> <path>' line per change and then the bytes of the index."""
+    try:
+        with open(main_backup_dir / 'fsmonitor-state', 'rb') as state_file:
+            token = state_file.readline().decode().rstrip('\n')
+            count = int(state_file.readline())
+            changes = {'M': set(), 'D': set(), 'U': set()}
+            for _ in range(count):
+                kind, _separator, path = state_file.readline().decode().rstrip('\n').partition(' ')
+                changes[kind].add(path)
+            index_data = state_file.read()
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    return token, index_data, changes['M'], changes['D'], changes['U']
+
+
+def write_fsmonitor_state(main_backup_dir, token, index_data, changes):
+    """A function that keeps the fsmonitor token, the bytes of the index and the changes
+    found by a comparison of the working tree to the index, for the next comparison."""
+    lines = [f'{kind} {path}\n' for kind, name in (('M', 'modified'), ('D', 'deleted'), ('U', 'untracked'))
+             for path in sorted(changes[name])]
+    content = f'{token}\n{len(lines)}\n{"".join(lines)}'.encode() + index_data
+    write_file_atomically(main_backup_dir / 'fsmonitor-state', content)
+
+
+def query_fsmonitor(main_backup_dir, token):
+    """A function that asks the fsmonitor daemon for the paths changed since the token
+    passed to it. Returns the new token and the list of changed paths, or None instead
+    of the list if the daemon can not tell (it was restarted or lost events), in which
+    case the whole working tree must be examined. Returns None if no daemon runs."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(FSMONITOR_TIMEOUT)
+            connection.connect(str(main_backup_dir / FSMONITOR_SOCKET))
+            connection.sendall(f'{token}\n'.encode())
+            with connection.makefile('rb') as reply:
+                lines = reply.read().decode().splitlines()
+    except OSError:
+        return None
+    if not lines:
+        return None
+    if lines[1:] == ['*']:
+        return lines[0], None
+    return lines[0], lines[1:]
+
+
+def describe_changes(added=(), modified=(), deleted=()):
+    """A function that labels lists of changed paths the way they are printed by status."""
+    return ([f'new file: {path}' for path in added]
+            + [f'modified: {path}' for path in modified]
+            + [f'deleted: {path}' for path in deleted])
+
+
+def make_index_entry(object_id, stat_result=None):
+    """A function that takes a blob id and the stat data of the working file it was
+    read from and returns an index entry. An entry made without stat data never
+    matches the working file, so the file is hashed again by the next status."""
+    if stat_result is None:
+        return IndexEntry(0, 0, 0, object_id)
+    return IndexEntry(stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, object_id)
+
+
+@traced
+def read_index(main_backup_dir):
+    """A function that reads the binary index file and returns a dictionary of the
+    staged paths and their index entries. The index file starts with a header of
+    signature, version and entry count, followed by one record of size, mtime_ns,
+    inode, sha1 digest and path length per entry, each followed by the path.
+    The parsed index is cached until the file changes and a copy is returned."""
+    index = read_cached_file(main_backup_dir / 'index', parse_index)
+    return {} if index is None else dict(index)
+
+
+def parse_index(data):
+    """A function that returns the dictionary of paths and index entries held by the
+    bytes of an index file."""
+    signature, version, count = INDEX_HEADER.unpack_from(data)
+    if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+        raise ValueError('Unsupported index file.')
+    index = {}
+    offset = INDEX_HEADER.size
+    for _ in range(count):
+        size, mtime_ns, inode, digest, path_length = INDEX_ENTRY.unpack_from(data, offset)
+        offset += INDEX_ENTRY.size
+        path = data[offset:offset + path_length].decode()
+        offset += path_length
+        index[path] = IndexEntry(size, mtime_ns, inode, digest.hex())
+    return index
+
+
+@traced
+def write_index(transaction, index):
+    """A function that writes the index dictionary to the binary index file as
+    part of a transaction."""
+    transaction.write('index', pack_index(index))
+
+
+def pack_index(index):
+    """A function that returns the bytes of the index file holding the index
+    dictionary passed to it."""
+    chunks = [INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(index))]
+    for path in sorted(index):
+        entry = index[path]
+        encoded_path = path.encode()
+        chunks.append(INDEX_ENTRY.pack(entry.size, entry.mtime_ns, entry.inode,
+                                       bytes.fromhex(entry.object_id), len(encoded_path)))
+        chunks.append(encoded_path)
+    return b''.join(chunks)
+
+
+def index_mtime_ns(main_backup_dir):
+    """A function that returns the modification time of the index file, or 0 if
+    there is no index yet."""
+    try:
+        return os.stat(main_backup_dir / 'index').st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def is_entry_clean(entry, stat_result, index_time):
+    """A function that checks if a working file still matches its index entry by
+    stat data alone. A file modified in the same clock tick the index was written
+    can not be trusted this way and is reported as not clean."""
+    return (entry.size == stat_result.st_size
+            and entry.mtime_ns == stat_result.st_mtime_ns
+            and entry.inode == stat_result.st_ino
+            and entry.mtime_ns < index_time)
+
+
+def find_tree_in_metadata(main_backup_dir, commit_id):
+    """A function that returns the tree id written in the commit id's metadata file.
+    Metadata files never change, so the tree ids are kept in TREE_IDS once read."""
+    key = (main_backup_dir, commit_id)
+    if key not in TREE_IDS:
+        with open(main_backup_dir / 'images' / f'{commit_id}.txt') as metadata_file:
+            for line in metadata_file:
+                if line.startswith('tree='):
+                    TREE_IDS[key] = line[5:-1]
+                    break
+            else:
+                return None
+    return TREE_IDS[key]
+
+
+def is_old_layout(main_backup_dir):
+    """A function that checks if a '.wit' directory was made by an older wit, which
+    kept full copies of the committed files in 'images/<commit id>' directories, the
+    staging area in 'staging_area' and the refs in 'references.txt'."""
+    return (main_backup_dir / 'staging_area').is_dir() or (main_backup_dir / 'references.txt').exists()
+
+
+def store_directory(main_backup_dir, directory):
+    """A function that stores every file of a directory in the object store and
+    returns the index holding them, with entries that never match a working file."""
+    return {path: make_index_entry(store_blob(main_backup_dir, directory / path))
+            for path, _stat_result in walk_files(directory)}
+
+
+def migrate_repository(main_backup_dir):
+    """A function that converts a repository made by an older wit. Every
+    'images/<commit id>' directory is stored as a tree whose id is added to the
+    commit's metadata file, so the commits keep their ids, the index is built from
+    'staging_area', the active branch is set to master and the head and branches of
+    'references.txt' move into the ref store, its 'master commit' line becoming the
+    master branch. The new files are written in one transaction and the old ones are
+    deleted only once it is committed, so a migration that fails leaves a repository
+    the older wit can still use and that is migrated again when it is next opened."""
+    images = main_backup_dir / 'images'
+    staging_area = main_backup_dir / 'staging_area'
+    references = main_backup_dir / 'references.txt'
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('references.txt')
+        if not is_old_layout(main_backup_dir):
+            return
+        (main_backup_dir / 'objects').mkdir(exist_ok=True)
+        image_dirs = [path for path in images.iterdir() if path.is_dir()] if images.is_dir() else []
+        for image_dir in image_dirs:
+            metadata_path = images / f'{image_dir.name}.txt'
+            if metadata_path.exists() and find_tree_in_metadata(main_backup_dir, image_dir.name) is None:
+                tree_id = write_index_tree(main_backup_dir, store_directory(main_backup_dir, image_dir))
+                write_file_atomically(metadata_path, metadata_path.read_bytes() + f'tree={tree_id}\n'.encode())
+        if staging_area.is_dir() and not (main_backup_dir / 'index').exists():
+            write_index(transaction, store_directory(main_backup_dir, staging_area))
+        if not (main_backup_dir / 'activated.txt').exists():
+            transaction.write('activated.txt', 'master')
+        if references.exists():
+            for line in references.read_text().splitlines():
+                title, _separator, commit_id = line.partition('=')
+                if title == 'HEAD':
+                    update_head(transaction, commit_id)
+                elif title == 'master commit':
+                    write_ref(transaction, 'refs/heads/master', commit_id)
+                elif title:
+                    write_ref(transaction, f'refs/heads/{title}', commit_id)
+            transaction.delete('references.txt')
+    for image_dir in image_dirs:
+        shutil.rmtree(image_dir)
+    if staging_area.is_dir():
+        shutil.rmtree(staging_area)
+
+
+@traced
+def read_head(main_backup_dir):
+    """A function that returns the commit id of the head, or None before the
+    first commit."""
+    try:
+        with open(main_backup_dir / 'HEAD', 'r') as head_file:
+            return head_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def determine_parent(main_backup_dir):
+    """A function that returns the commit id of the head or 'None' if
+    there is none."""
+    return read_head(main_backup_dir) or 'None'
+
+
+def find_packed_ref(main_backup_dir, ref_name):
+    """A function that looks a ref up in the packed-refs file by binary search.
+    The file holds one '<commit id> <ref name>' line per ref, sorted by name,
+    and is mapped into memory so only the probed lines are read."""
+    packed_refs = main_backup_dir / 'packed-refs'
+    if not packed_refs.exists() or packed_refs.stat().st_size == 0:
+        return None
+    target = ref_name.encode()
+    with open(packed_refs, 'rb') as packed_file:
+        with mmap.mmap(packed_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            low, high = 0, len(data)
+            while low < high:
+                line_start = data.rfind(b'\n', 0, (low + high) // 2) + 1
+                line_end = data.find(b'\n', line_start)
+                name = data[line_start + 41:line_end]
+                if name == target:
+                    return data[line_start:line_start + 40].decode()
+                if name < target:
+                    low = line_end + 1
+                else:
+                    high = line_start
+    return None
+
+
+@traced
+def read_ref(main_backup_dir, ref_name):
+    """A function that takes a ref name such as 'refs/heads/master' and returns its
+    commit id, or None if there is no such ref. A loose ref file is a single stat
+    and read; refs that were packed are found by binary search in packed-refs."""
+    try:
+        with open(main_backup_dir / ref_name, 'r') as ref_file:
+            return ref_file.read().strip()
+    except (FileNotFoundError, IsADirectoryError):
+        return find_packed_ref(main_backup_dir, ref_name)
+
+
+def write_ref(transaction, ref_name, commit_id):
+    """A function that points a single ref at a commit id as part of a transaction,
+    without rewriting any other ref."""
+    transaction.write(ref_name, f'{commit_id}\n')
+
+
+@traced
+def list_refs(main_backup_dir, prefix='refs/'):
+    """A function that returns a dictionary of every ref name starting with the
+    prefix and its commit id. Loose refs take precedence over packed ones."""
+    refs = {}
+    if (main_backup_dir / 'packed-refs').exists():
+        with open(main_backup_dir / 'packed-refs', 'r') as packed_file:
+            for line in packed_file:
+                commit_id, ref_name = line.rstrip('\n').split(' ', 1)
+                if ref_name.startswith(prefix):
+                    refs[ref_name] = commit_id
+    refs_dir = main_backup_dir / 'refs'
+    if refs_dir.exists():
+        for ref_name, _stat_result in walk_files(refs_dir):
+            ref_name = f'refs/{ref_name}'
+            if ref_name.startswith(prefix) and not ref_name.endswith('.lock'):
+                refs[ref_name] = read_ref(main_backup_dir, ref_name)
+    return refs
+
+
+@traced
+def pack_refs(repository):
+    """A function that moves all loose refs into the sorted packed-refs file and
+    deletes the loose ref files."""
+    main_backup_dir = repository.main_backup_dir
+    refs_dir = main_backup_dir / 'refs'
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('packed-refs')
+        if refs_dir.exists():
+            for path, _stat_result in walk_files(refs_dir):
+                if not path.endswith('.lock'):
+                    transaction.delete(f'refs/{path}')
+        refs = list_refs(main_backup_dir)
+        transaction.write('packed-refs', ''.join(f'{refs[ref_name]} {ref_name}\n' for ref_name in sorted(refs)))
+
+
+def list_loose_objects(main_backup_dir):
+    """A function that returns a dictionary of the ids of the loose objects in the
+    object store, chunked files included, and their paths."""
+    objects = {}
+    objects_dir = main_backup_dir / 'objects'
+    for path, _stat_result in walk_files(objects_dir):
+        prefix, _separator, name = path.partition('/')
+        if len(prefix) == 2 and (len(name) == 38 or (len(name) == 45 and name.endswith('.chunks'))):
+            objects[prefix + name[:38]] = objects_dir / path
+    return objects
+
+
+def collect_object_names(main_backup_dir):
+    """A function that walks the trees of every commit and returns a dictionary of
+    the reachable object ids and the (kind, name) they were first found under. Trees
+    that were already walked are skipped, so unchanged directories are read once."""
+    names = {}
+    pending = [find_tree_in_metadata(main_backup_dir, path.stem)
+               for path in sorted((main_backup_dir / 'images').glob('*.txt'))]
+    for tree_id in pending:
+        names.setdefault(tree_id, ('tree', ''))
+    while pending:
+        for kind, object_id, name in read_tree(main_backup_dir, pending.pop()):
+            if object_id not in names:
+                names[object_id] = (kind, name)
+                if kind == 'tree':
+                    pending.append(object_id)
+    return names
+
+
+def object_size(main_backup_dir, object_id):
+    """A function that returns the size of an object without reading its content.
+    The size of a chunked file is that of its manifest."""
+    for path in object_path(main_backup_dir, object_id), chunk_manifest_path(main_backup_dir, object_id):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            pass
+    pack_data, offset = find_packed_entry(main_backup_dir, object_id)
+    return PACK_ENTRY.unpack_from(pack_data, offset)[2]
+
+
+@traced
+def write_pack(pack_file, main_backup_dir, object_ids, names):
+    """A function that writes the objects passed to it into a pack file and returns
+    a dictionary of their raw ids and offsets along with the number of deltas.
+    Objects are sorted by kind, name and size, largest first, and every object is
+    compared with the PACK_WINDOW objects before it. It is stored as a delta against
+    the one giving the smallest delta, if that delta is under half of its size and the
+    chain stays under PACK_DEPTH deltas, and as a whole object otherwise. The chunks
+    of chunked files are packed like any object and their manifests are packed as
+    they are. Everything is compressed with zlib."""
+    order = sorted(object_ids, key=lambda object_id: (
+        *names.get(object_id, ('', '')), -object_size(main_backup_dir, object_id), object_id))
+    pack_file.write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(order)))
+    offsets = {}
+    depths = {}
+    window = collections.deque(maxlen=PACK_WINDOW)
+    deltas = 0
+    for object_id in order:
+        chunks = read_chunk_manifest(main_backup_dir, object_id)
+        if chunks is not None:
+            manifest = ''.join(f'{chunk_id} {size}\n' for chunk_id, size in chunks).encode()
+            offsets[bytes.fromhex(object_id)] = pack_file.tell()
+            compressed = zlib.compress(manifest)
+            pack_file.write(PACK_ENTRY.pack(PACK_CHUNKS, bytes(20), len(manifest), len(compressed)))
+            pack_file.write(compressed)
+            continue
+        data = read_object(main_backup_dir, object_id)
+        best_base, best_delta = None, None
+        for base_id, base, base_lines in window:
+            if depths[base_id] + 1 >= PACK_DEPTH:
+                continue
+            delta = make_delta(base, base_lines, data)
+            if len(delta) < len(data) // 2 and (best_delta is None or len(delta) < len(best_delta)):
+                best_base, best_delta = base_id, delta
+        offsets[bytes.fromhex(object_id)] = pack_file.tell()
+        if best_base is None:
+            depths[object_id] = 0
+            compressed = zlib.compress(data)
+            pack_file.write(PACK_ENTRY.pack(PACK_FULL, bytes(20), len(data), len(compressed)))
+        else:
+            depths[object_id] = depths[best_base] + 1
+            deltas += 1
+            compressed = zlib.compress(best_delta)
+            pack_file.write(PACK_ENTRY.pack(PACK_DELTA, bytes.fromhex(best_base), len(data), len(compressed)))
+        pack_file.write(compressed)
+        window.append((object_id, data, index_lines(data)))
+    return offsets, deltas
+
+
+def write_pack_index(index_file, offsets):
+    """A function that writes the index of a pack file: a header, a fanout table
+    holding the number of ids up to every first byte, the sorted raw ids and their
+    offsets in the pack."""
+    raw_ids = sorted(offsets)
+    fanout = [0] * 256
+    for raw_id in raw_ids:
+        fanout[raw_id[0]] += 1
+    for first_byte in range(1, 256):
+        fanout[first_byte] += fanout[first_byte - 1]
+    index_file.write(PACK_INDEX_HEADER.pack(PACK_INDEX_SIGNATURE, PACK_INDEX_VERSION, len(raw_ids)))
+    index_file.write(PACK_FANOUT.pack(*fanout))
+    index_file.write(b''.join(raw_ids))
+    index_file.write(b''.join(PACK_OFFSET.pack(offsets[raw_id]) for raw_id in raw_ids))
+
+
+def write_pack_file(pack_directory, name, write_content):
+    """A function that writes a file of the pack directory through a temp file that
+    is flushed to disk before it is renamed into place."""
+    temp_fd, temp_file = tempfile.mkstemp(dir=pack_directory, suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as file:
+            result = write_content(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_file, 0o444)
+        os.replace(temp_file, pack_directory / name)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+    return result
+
+
+@traced
+def repack(repository):
+    """A function that moves every object of the object store, loose or packed, into
+    a single delta-compressed pack file with its index, then deletes the loose objects
+    and the old packs. The pack is on disk before anything is deleted, so a crash
+    leaves every object readable. Returns the number of packed objects and deltas."""
+    main_backup_dir = repository.main_backup_dir
+    pack_directory = main_backup_dir / 'objects' / 'pack'
+    pack_directory.mkdir(parents=True, exist_ok=True)
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('objects/pack/repack')
+        loose_objects = list_loose_objects(main_backup_dir)
+        old_indexes = read_pack_indexes(main_backup_dir)
+        object_ids = set(loose_objects)
+        for _pack_path, index_data in old_indexes:
+            count = PACK_INDEX_HEADER.unpack_from(index_data)[2]
+            ids_start = PACK_INDEX_HEADER.size + PACK_FANOUT.size
+            object_ids.update(index_data[position:position + 20].hex()
+                              for position in range(ids_start, ids_start + count * 20, 20))
+        if not object_ids:
+            return 0, 0
+        name = 'pack-' + hashlib.sha1(''.join(sorted(object_ids)).encode()).hexdigest()
+        offsets, deltas = write_pack_file(
+            pack_directory, f'{name}.pack',
+            lambda pack_file: write_pack(pack_file, main_backup_dir, object_ids, collect_object_names(main_backup_dir)))
+        write_pack_file(pack_directory, f'{name}.idx', lambda index_file: write_pack_index(index_file, offsets))
+        sync_directory(pack_directory)
+        for pack_path, _index_data in old_indexes:
+            if pack_path.stem != name:
+                PACK_INDEXES.pop(pack_path.with_suffix('.idx'), None)
+                PACK_MAPS.pop(pack_path, None)
+                pack_path.with_suffix('.idx').unlink()
+                pack_path.unlink()
+        for path in loose_objects.values():
+            path.unlink()
+        for directory in (main_backup_dir / 'objects').iterdir():
+            if directory != pack_directory and directory.is_dir() and not any(directory.iterdir()):
+                directory.rmdir()
+    return len(object_ids), deltas
+
+
+@traced
+def gc(repository):
+    """A function that packs the refs and the objects of the repository and adds the
+    missing changed-path Bloom filters."""
+    pack_refs(repository)
+    write_bloom_filters(repository)
+    return repack(repository)
+
+
+def read_active_branch(main_backup_dir):
+    """A function that returns the branch activated in the 'activated.txt' file."""
+    with open(main_backup_dir / 'activated.txt', 'r') as activated:
+        return activated.read()
+
+
+def make_meta_data(backup_dir, message, parent, tree_id, now):
+    """A function that takes a path, a message, the parent commit id, the id of
+    the committed tree and the commit time, and generates a metadata txt file.
+    The commit id is the sha1 of the metadata content, so it can be verified by
+    hashing the file again. Returns the commit id."""
     date = now.strftime('%c')
-    with open(backup_dir / f'{commit_id}.txt', 'w') as meta_file:
-        meta_file.write(f'parent={parent}\n')
-        meta_file.write(f'date={date} +0300\n')
-        meta_file.write(f'message={message}\n')
-
-
-def replace_dir_content(dst, src):
-    """A function that takes a source path and a destination path,
-    empties the destination directory, and then fills it with the
-    contents of ths source directory."""
-    dst_files = os.listdir(dst)
-    for file in dst_files:
-        item = dst / file
-        pathlib.Path.unlink(item)
-    src_files = os.listdir(src)
-    for file in src_files:
-        copy_file_or_dir(src / file, dst / file)
-
-
-def update_head(wit_dir, commit_id):
-    """A function that takes a path for the main wit directory and a commit_id string
-    and updates the references file."""
-    with open(wit_dir / 'references.txt', 'r') as references:
-        lines = references.readlines()
-        lines[0] = f'HEAD={commit_id}\n'
-    with open(wit_dir / 'references.txt', 'w') as references:
-        references.writelines(lines)
-
-def update_master(main_backup_dir, commit_id):
-    with open(main_backup_dir / 'references.txt', 'r') as references:
-        lines = references.readlines()
-        print(lines[0])
-        print(lines[1])
-        HEAD = lines[0][5:45]
-        print(HEAD)
-        master = lines[1][14:54]
-        print(master)
-    if HEAD == master:
-        with open(main_backup_dir / 'references.txt', 'r') as references:
-            lines = references.readlines()
-            lines[1] = f'master commit={HEAD}\n'
-        with open(main_backup_dir / 'references.txt', 'w') as references:
-            references.writelines(lines)
+    content = (f'parent={parent}\n'
+               f'date={date} +0300\n'
+               f'message={message}\n'
+               f'tree={tree_id}\n').encode()
+    commit_id = hashlib.sha1(content).hexdigest()
+    write_file_atomically(backup_dir / f'{commit_id}.txt', content)
+    UNSYNCED_FILES.add(backup_dir / f'{commit_id}.txt')
+    return commit_id
+
+
+def update_head(transaction, commit_id):
+    """A function that takes a transaction and a commit_id string and updates
+    the HEAD file."""
+    transaction.write('HEAD', f'{commit_id}\n')
+
+
+def update_references(transaction, head, commit_id):
+    """A function that updates the references in the commit function. If the active
+    branch points at the previous head (or does not exist yet on the first commit)
+    it is moved to the new commit id along with the head. Otherwise only the head
+    is changed."""
+    active_branch = read_active_branch(transaction.main_backup_dir)
+    active_branch_id = read_ref(transaction.main_backup_dir, f'refs/heads/{active_branch}')
+    if active_branch_id == head or (active_branch_id is None and head == 'None'):
+        write_ref(transaction, f'refs/heads/{active_branch}', commit_id)
+    update_head(transaction, commit_id)
+
+
+def pop_option(args, name, default=None):
+    """A function that removes an option and its value from a list of command line
+    arguments and returns the value, or the default if the option was not passed."""
+    if name not in args:
+        return default
+    position = args.index(name)
+    value = args[position + 1]
+    del args[position:position + 2]
+    return value
+
+
+def pop_flag(args, name):
+    """A function that removes a flag from a list of command line arguments and
+    returns whether it was passed."""
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+def print_dict(dictionary):
+    """A function that prints the key-value pairs of a dictionary line by line."""
+    for key in dictionary:
+        print(f'{key}: {dictionary[key]}')
+
+
+def check_status(stat):
+    """A function the checks if there are changes not yet committed or staged.
+    If there are such changes it raises an UnsavedChangesError holding the status
+    dictionary, which stops the checkout process and informs the user."""
+    if stat['Changes to be committed'] != [] or stat['Changes not staged for commit'] != []:
+        raise UnsavedChangesError(stat)
+
+
+def find_parents_in_metadata(main_backup_dir, commit_id):
+    """A function that returns the list of parents in the commit id's metadata file.
+    Merge commits have two parents, the first commit has none."""
+    with open(main_backup_dir / 'images' / f'{commit_id}.txt') as metadata_file:
+        parent_line = metadata_file.readline()[7:-1]
+    if parent_line == 'None':
+        return []
+    return [parent.strip() for parent in parent_line.split(',')]
+
+
+def find_time_in_metadata(main_backup_dir, commit_id):
+    """A function that returns the commit time in the commit id's metadata file
+    as seconds since the epoch."""
+    with open(main_backup_dir / 'images' / f'{commit_id}.txt') as metadata_file:
+        for line in metadata_file:
+            if line.startswith('date='):
+                date = line[5:-1].rsplit(' ', 1)[0]
+                return int(datetime.strptime(date, '%c').timestamp())
+    return 0
+
+
+def empty_commit_graph():
+    """A function that returns a commit graph with no commits."""
+    return CommitGraph([], {}, [], [], [])
+
+
+def add_to_commit_graph(graph, commit_id, parents, commit_time):
+    """A function that adds a commit whose parents are already in the graph and
+    returns its generation number, which is one more than its highest parent's."""
+    parent_positions = tuple(graph.positions[parent] for parent in parents)
+    generation = 1 + max((graph.generations[position] for position in parent_positions), default=0)
+    graph.positions[commit_id] = len(graph.ids)
+    graph.ids.append(commit_id)
+    graph.parents.append(parent_positions)
+    graph.generations.append(generation)
+    graph.times.append(commit_time)
+    return generation
+
+
+def pack_graph_record(graph, position):
+    """A function that returns the binary record of the commit at a position in the
+    graph: the commit id, the positions of up to two parents, the generation number
+    and the commit time."""
+    parents = graph.parents[position] + (NO_PARENT, NO_PARENT)
+    return GRAPH_RECORD.pack(bytes.fromhex(graph.ids[position]), parents[0], parents[1],
+                             graph.generations[position], graph.times[position])
+
+
+def build_commit_graph(main_backup_dir):
+    """A function that builds the commit-graph file from the metadata files of all
+    commits, for repositories created before the file existed. Returns the graph."""
+    commit_ids = [path.stem for path in (main_backup_dir / 'images').glob('*.txt')]
+    parents = {commit_id: find_parents_in_metadata(main_backup_dir, commit_id) for commit_id in commit_ids}
+    graph = empty_commit_graph()
+    pending = list(commit_ids)
+    while pending:
+        commit_id = pending.pop()
+        if commit_id in graph.positions:
+            continue
+        missing = [parent for parent in parents[commit_id] if parent not in graph.positions]
+        if missing:
+            pending.append(commit_id)
+            pending.extend(missing)
+            continue
+        add_to_commit_graph(graph, commit_id, parents[commit_id],
+                            find_time_in_metadata(main_backup_dir, commit_id))
+    records = [pack_graph_record(graph, position) for position in range(len(graph.ids))]
+    write_file_atomically(main_backup_dir / 'commit-graph',
+                          GRAPH_HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION) + b''.join(records))
+    return graph
+
+
+@traced
+def read_commit_graph(main_backup_dir):
+    """A function that loads the binary commit-graph file into memory. The file is a
+    header followed by one fixed size record per commit, parents always before their
+    children, so it can be appended to on every commit. A record left incomplete
+    by a crash while appending is ignored. The graph is cached until the file
+    changes and must not be modified by the caller."""
+    graph = read_cached_file(main_backup_dir / 'commit-graph', parse_commit_graph)
+    if graph is None:
+        return build_commit_graph(main_backup_dir)
+    return graph
+
+
+def parse_commit_graph(data):
+    """A function that returns the commit graph held by the bytes of a commit-graph
+    file."""
+    signature, version = GRAPH_HEADER.unpack_from(data)
+    if signature != GRAPH_SIGNATURE or version != GRAPH_VERSION:
+        raise ValueError('Unsupported commit-graph file.')
+    graph = empty_commit_graph()
+    end = GRAPH_HEADER.size + (len(data) - GRAPH_HEADER.size) // GRAPH_RECORD.size * GRAPH_RECORD.size
+    records = GRAPH_RECORD.iter_unpack(data[GRAPH_HEADER.size:end])
+    for digest, first_parent, second_parent, generation, commit_time in records:
+        graph.positions[digest.hex()] = len(graph.ids)
+        graph.ids.append(digest.hex())
+        graph.parents.append(tuple(parent for parent in (first_parent, second_parent) if parent != NO_PARENT))
+        graph.generations.append(generation)
+        graph.times.append(commit_time)
+    return graph
+
+
+def append_to_commit_graph(transaction, commit_id, parents, commit_time):
+    """A function that records a new commit at the end of the commit-graph file.
+    The file is locked for the rest of the transaction and appended to in place."""
+    main_backup_dir = transaction.main_backup_dir
+    transaction.lock('commit-graph')
+    graph_path = main_backup_dir / 'commit-graph'
+    graph = read_commit_graph(main_backup_dir)
+    if commit_id in graph.positions:
+        return
+    FILE_CACHES.pop(graph_path, None)
+    add_to_commit_graph(graph, commit_id, parents, commit_time)
+    with open(graph_path, 'ab') as graph_file:
+        graph_file.write(pack_graph_record(graph, graph.positions[commit_id]))
+        graph_file.flush()
+        os.fsync(graph_file.fileno())
+    FILE_CACHES[graph_path] = (file_cache_key(graph_path), graph)
+
+
+@traced
+def changed_paths(main_backup_dir, old_tree_id, new_tree_id):
+    """A function that returns the set of paths that differ between two trees,
+    the directories holding the changed files included."""
+    added, modified, deleted = compare_trees(main_backup_dir, old_tree_id, new_tree_id)
+    paths = set()
+    for path in [*added, *modified, *deleted]:
+        while path and path not in paths:
+            paths.add(path)
+            path = path.rpartition('/')[0]
+    return paths
+
+
+def bloom_positions(path, bits):
+    """A function that returns the BLOOM_HASHES bit positions of a path in a Bloom
+    filter of the given number of bits, by double hashing one blake2b digest."""
+    digest = hashlib.blake2b(path.encode(), digest_size=8).digest()
+    first, second = struct.unpack('>II', digest)
+    return [(first + number * second) % bits for number in range(BLOOM_HASHES)]
+
+
+def make_bloom_filter(paths):
+    """A function that returns a Bloom filter of the paths passed to it, with about
+    BLOOM_BITS_PER_PATH bits per path. A commit that changed more than BLOOM_MAX_PATHS
+    paths gets a filter with every bit set, which matches any path."""
+    if len(paths) > BLOOM_MAX_PATHS:
+        return b'\xff'
+    bloom = bytearray((len(paths) * BLOOM_BITS_PER_PATH + 7) // 8)
+    for path in paths:
+        for position in bloom_positions(path, len(bloom) * 8):
+            bloom[position // 8] |= 1 << position % 8
+    return bytes(bloom)
+
+
+def bloom_contains(bloom, path):
+    """A function that checks if a path may be in a Bloom filter. False means the
+    path is certainly not in it. An empty filter holds no paths."""
+    if not bloom:
+        return False
+    return all(bloom[position // 8] & 1 << position % 8 for position in bloom_positions(path, len(bloom) * 8))
+
+
+@traced
+def read_bloom_filters(main_backup_dir):
+    """A function that returns a dictionary of commit ids and the Bloom filters of the
+    paths they changed from their first parent, from the commit-graph-bloom file. The
+    file is a header followed by one record per commit, the id and the length of the
+    filter and then the filter. Like the commit-graph it is only appended to, and a
+    record left incomplete by a crash is ignored. The filters are cached until the
+    file changes."""
+    return read_cached_file(main_backup_dir / 'commit-graph-bloom', parse_bloom_filters) or {}
+
+
+def parse_bloom_filters(data):
+    """A function that returns the dictionary of commit ids and Bloom filters held by
+    the bytes of a commit-graph-bloom file."""
+    blooms = {}
+    signature, version = BLOOM_HEADER.unpack_from(data)
+    if signature != BLOOM_SIGNATURE or version != BLOOM_VERSION:
+        raise ValueError('Unsupported commit-graph-bloom file.')
+    position = BLOOM_HEADER.size
+    while position + BLOOM_RECORD.size <= len(data):
+        digest, length = BLOOM_RECORD.unpack_from(data, position)
+        position += BLOOM_RECORD.size
+        if position + length > len(data):
+            break
+        blooms[digest.hex()] = data[position:position + length]
+        position += length
+    return blooms
+
+
+def append_bloom_filters(transaction, filters):
+    """A function that appends the Bloom filters of a dictionary of commit ids and
+    changed paths to the commit-graph-bloom file, which is locked for the rest of
+    the transaction."""
+    main_backup_dir = transaction.main_backup_dir
+    transaction.lock('commit-graph-bloom')
+    records = []
+    for commit_id, paths in filters.items():
+        bloom = make_bloom_filter(paths)
+        records.append(BLOOM_RECORD.pack(bytes.fromhex(commit_id), len(bloom)) + bloom)
+    with open(main_backup_dir / 'commit-graph-bloom', 'ab') as bloom_file:
+        if bloom_file.tell() == 0:
+            bloom_file.write(BLOOM_HEADER.pack(BLOOM_SIGNATURE, BLOOM_VERSION))
+        bloom_file.write(b''.join(records))
+        bloom_file.flush()
+        os.fsync(bloom_file.fileno())
+
+
+def write_bloom_filters(repository):
+    """A function that adds the Bloom filters of the commits made before filters were
+    kept. Returns the number of filters written."""
+    main_backup_dir = repository.main_backup_dir
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('commit-graph-bloom')
+        graph = read_commit_graph(main_backup_dir)
+        blooms = read_bloom_filters(main_backup_dir)
+        filters = {}
+        for position, commit_id in enumerate(graph.ids):
+            if commit_id in blooms:
+                continue
+            parents = graph.parents[position]
+            parent_tree_id = find_tree_in_metadata(main_backup_dir, graph.ids[parents[0]]) if parents else None
+            filters[commit_id] = changed_paths(main_backup_dir, parent_tree_id,
+                                               find_tree_in_metadata(main_backup_dir, commit_id))
+        if filters:
+            append_bloom_filters(transaction, filters)
+    return len(filters)
+
+
+@traced
+def is_ancestor(graph, ancestor_id, commit_id):
+    """A function that checks if a commit is an ancestor of (or the same as) another
+    commit. Commits with a generation number lower than the ancestor's can not
+    reach it, so their parents are not followed."""
+    target = graph.positions[ancestor_id]
+    target_generation = graph.generations[target]
+    pending = [graph.positions[commit_id]]
+    seen = set(pending)
+    while pending:
+        position = pending.pop()
+        if position == target:
+            return True
+        for parent in graph.parents[position]:
+            if parent not in seen and graph.generations[parent] >= target_generation:
+                seen.add(parent)
+                pending.append(parent)
+    return False
+
+
+@traced
+def find_merge_bases(graph, first_id, second_id):
+    """A function that returns the best common ancestors of two commits, the ones
+    that are not ancestors of another common ancestor. There is more than one in
+    criss-cross histories. Commits are visited from the highest generation down
+    through a priority queue, marking which of the two commits reach them; a commit
+    reached from both is a merge base and everything below it is marked stale.
+    The walk stops as soon as only stale commits are left, and each commit is
+    visited at most once per combination of marks, whatever the number of parents."""
+    first = graph.positions[first_id]
+    second = graph.positions[second_id]
+    if first == second:
+        return [first_id]
+    marks = {first: FROM_FIRST, second: FROM_SECOND}
+    queue = [(-graph.generations[first], first), (-graph.generations[second], second)]
+    heapq.heapify(queue)
+    bases = []
+    while any(not marks[position] & STALE for _generation, position in queue):
+        _generation, position = heapq.heappop(queue)
+        position_marks = marks[position]
+        if position_marks & (FROM_FIRST | FROM_SECOND | STALE) == FROM_FIRST | FROM_SECOND:
+            bases.append(position)
+            position_marks |= STALE
+            marks[position] = position_marks
+        for parent in graph.parents[position]:
+            if marks.get(parent, 0) & position_marks == position_marks:
+                continue
+            marks[parent] = marks.get(parent, 0) | position_marks
+            heapq.heappush(queue, (-graph.generations[parent], parent))
+    best = [position for position in bases
+            if not any(other != position and is_ancestor(graph, graph.ids[position], graph.ids[other])
+                       for other in bases)]
+    return [graph.ids[position] for position in best]
+
+
+def find_tree_entry(main_backup_dir, tree_id, path):
+    """A function that returns the (kind, object id) of the file or directory at the
+    path in the tree, or (None, None) if there is none. The empty path is the tree
+    itself. Only the trees along the path are read."""
+    if tree_id is None:
+        return None, None
+    kind, object_id = 'tree', tree_id
+    for name in path.split('/') if path else []:
+        if kind != 'tree':
+            return None, None
+        entries = {entry_name: (entry_kind, entry_id)
+                   for entry_kind, entry_id, entry_name in read_tree(main_backup_dir, object_id)}
+        kind, object_id = entries.get(name, (None, None))
+        if kind is None:
+            return None, None
+    return kind, object_id
+
+
+def find_blob_in_tree(main_backup_dir, tree_id, path):
+    """A function that returns the blob id stored at the path in the tree, or None
+    if there is no such blob."""
+    kind, object_id = find_tree_entry(main_backup_dir, tree_id, path)
+    return object_id if kind == 'blob' else None
+
+
+def read_metadata(main_backup_dir, commit_id):
+    """A function that returns the 'key=value' lines of a commit's metadata file as
+    a dictionary."""
+    metadata = {}
+    with open(main_backup_dir / 'images' / f'{commit_id}.txt') as metadata_file:
+        for line in metadata_file:
+            key, _separator, value = line.rstrip('\n').partition('=')
+            metadata[key] = value
+    return metadata
+
+
+def make_commit_record(metadata):
+    """A function that turns a commit's metadata dictionary, with its id under the
+    'commit' key as log yields it, into a Commit."""
+    parent = metadata.get('parent', 'None')
+    parents = () if parent == 'None' else tuple(parent_id.strip() for parent_id in parent.split(','))
+    return Commit(metadata['commit'], parents, metadata.get('date'), metadata.get('message'), metadata.get('tree'))
+
+
+def read_commit(main_backup_dir, commit_id):
+    """A function that returns the Commit of a commit id."""
+    return make_commit_record({'commit': commit_id, **read_metadata(main_backup_dir, commit_id)})
+
+
+def walk_commits(graph, commit_id, first_parent=False, since=None):
+    """A generator that yields the ids of a commit and its ancestors, newest first,
+    from the commit graph alone. A heap ordered by commit time (and generation for
+    commits made in the same second) holds the commits still to be shown, so each
+    commit is yielded as soon as it is reached and the walk costs nothing beyond the
+    commits that are read. With first_parent only the first parent of merges is
+    followed. The walk stops at the first commit older than since, in seconds."""
+    position = graph.positions[commit_id]
+    pending = [(-graph.times[position], -graph.generations[position], position)]
+    seen = {position}
+    while pending:
+        _time, _generation, position = heapq.heappop(pending)
+        if since is not None and graph.times[position] < since:
+            return
+        yield graph.ids[position]
+        parents = graph.parents[position][:1] if first_parent else graph.parents[position]
+        for parent in parents:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(pending, (-graph.times[parent], -graph.generations[parent], parent))
+
+
+def commit_touches_paths(main_backup_dir, graph, commit_id, paths, first_parent=False, blooms=None):
+    """A function that checks if a commit changed any of the paths passed to it.
+    A commit that left the paths as they were in one of its parents did not change
+    them, so merges only count when they differ from every parent. If the commit's
+    Bloom filter of changed paths holds none of the paths, the commit left them as
+    they were in its first parent and no tree is read. Otherwise only the trees
+    along the paths are read."""
+    bloom = (blooms or {}).get(commit_id)
+    if bloom is not None and '' not in paths and not any(bloom_contains(bloom, path) for path in paths):
+        return False
+    tree_id = find_tree_in_metadata(main_backup_dir, commit_id)
+    parents = graph.parents[graph.positions[commit_id]]
+    if first_parent:
+        parents = parents[:1]
+    parent_tree_ids = [find_tree_in_metadata(main_backup_dir, graph.ids[parent]) for parent in parents] or [None]
+    entries = [find_tree_entry(main_backup_dir, tree_id, path) for path in paths]
+    return all(entries != [find_tree_entry(main_backup_dir, parent_tree_id, path) for path in paths]
+               for parent_tree_id in parent_tree_ids)
+
+
+def find_sync_regions(base, ours, theirs):
+    """A function that returns the regions of the base lines that are unchanged on both
+    sides, as tuples of the region's start and end in the base and its start in ours and
+    in theirs. The last region is an empty one at the end of all three."""
+    ours_blocks = difflib.SequenceMatcher(None, base, ours, autojunk=False).get_matching_blocks()
+    theirs_blocks = difflib.SequenceMatcher(None, base, theirs, autojunk=False).get_matching_blocks()
+    regions = []
+    ours_position = theirs_position = 0
+    while ours_position < len(ours_blocks) and theirs_position < len(theirs_blocks):
+        ours_base, ours_start, ours_length = ours_blocks[ours_position]
+        theirs_base, theirs_start, theirs_length = theirs_blocks[theirs_position]
+        start = max(ours_base, theirs_base)
+        end = min(ours_base + ours_length, theirs_base + theirs_length)
+        if start < end:
+            regions.append((start, end, ours_start + start - ours_base, theirs_start + start - theirs_base))
+        if ours_base + ours_length < theirs_base + theirs_length:
+            ours_position += 1
+        else:
+            theirs_position += 1
+    regions.append((len(base), len(base), len(ours), len(theirs)))
+    return regions
+
+
+def merge_lines(base, ours, theirs, branch_name):
+    """A function that makes a line-level three-way merge of two lists of lines with
+    their common base. A hunk changed on one side only takes that side's lines, a hunk
+    changed on both sides in different ways is written between conflict markers.
+    Returns the merged lines and whether there was a conflict."""
+    merged = []
+    conflict = False
+    base_position = ours_position = theirs_position = 0
+    for base_start, base_end, ours_start, theirs_start in find_sync_regions(base, ours, theirs):
+        base_hunk = base[base_position:base_start]
+        ours_hunk = ours[ours_position:ours_start]
+        theirs_hunk = theirs[theirs_position:theirs_start]
+        if ours_hunk == theirs_hunk or theirs_hunk == base_hunk:
+            merged.extend(ours_hunk)
+        elif ours_hunk == base_hunk:
+            merged.extend(theirs_hunk)
+        else:
+            conflict = True
+            merged.append(b'<<<<<<< HEAD\n')
+            merged.extend(ensure_newline(ours_hunk))
+            merged.append(b'=======\n')
+            merged.extend(ensure_newline(theirs_hunk))
+            merged.append(f'>>>>>>> {branch_name}\n'.encode())
+        merged.extend(base[base_start:base_end])
+        base_position = base_end
+        ours_position = ours_start + base_end - base_start
+        theirs_position = theirs_start + base_end - base_start
+    return merged, conflict
+
+
+def ensure_newline(lines):
+    """A function that returns the lines with a newline added to the last one if it
+    has none, so that a conflict marker after them starts on its own line."""
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+@traced
+def merge_blobs(main_backup_dir, base_id, ours_id, theirs_id, branch_name):
+    """A function that merges the content of two blobs with their base blob, which is
+    None if the file was added on both sides. Returns the merged content and whether
+    there was a conflict. Binary files are not merged and conflict with our side kept."""
+    base = b'' if base_id is None else read_object(main_backup_dir, base_id)
+    ours = read_object(main_backup_dir, ours_id)
+    theirs = read_object(main_backup_dir, theirs_id)
+    if b'\0' in base or b'\0' in ours or b'\0' in theirs:
+        return ours, True
+    merged, conflict = merge_lines(base.splitlines(keepends=True), ours.splitlines(keepends=True),
+                                   theirs.splitlines(keepends=True), branch_name)
+    return b''.join(merged), conflict
+
+
+def myers_diff(old, new):
+    """A function that finds a shortest edit script between two lists of lines with
+    Myers' algorithm and returns it as a list of ('equal', 'delete' or 'insert',
+    old position, new position) steps, one per line. The common prefix and suffix
+    are taken off first, as most diffs only touch a small part of a file. Returns
+    None if the lists differ by more than DIFF_MAX_EDITS lines, since the time and
+    the frontiers kept for the backtracking grow with the square of the edits. Lines
+    of one list missing from the other must all be edited, so lists with too many of
+    them are given up on at once. Every frontier is kept as the list slice of the
+    diagonals the backtracking reads from it."""
+    prefix = 0
+    while prefix < len(old) and prefix < len(new) and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < len(old) - prefix and suffix < len(new) - prefix
+           and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]):
+        suffix += 1
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+    old_length, new_length = len(old_middle), len(new_middle)
+    common = sum((collections.Counter(old_middle) & collections.Counter(new_middle)).values())
+    if old_length + new_length - 2 * common > DIFF_MAX_EDITS:
+        return None
+    max_edits = min(old_length + new_length, DIFF_MAX_EDITS)
+    offset = max_edits + 1
+    frontier = [0] * (2 * max_edits + 3)
+    trace = []
+    for edits in range(max_edits + 1):
+        trace.append(frontier[offset - edits - 1:offset + edits + 2])
+        for diagonal in range(-edits, edits + 1, 2):
+            index = offset + diagonal
+            if diagonal == -edits or (diagonal != edits and frontier[index - 1] < frontier[index + 1]):
+                x = frontier[index + 1]
+            else:
+                x = frontier[index - 1] + 1
+            y = x - diagonal
+            while x < old_length and y < new_length and old_middle[x] == new_middle[y]:
+                x += 1
+                y += 1
+            frontier[index] = x
+            if x >= old_length and y >= new_length:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+    steps = []
+    x, y = old_length, new_length
+    for edits in range(len(trace) - 1, -1, -1):
+        frontier = trace[edits]
+        diagonal = x - y
+        index = diagonal + edits + 1
+        if diagonal == -edits or (diagonal != edits and frontier[index - 1] < frontier[index + 1]):
+            previous_diagonal = diagonal + 1
+        else:
+            previous_diagonal = diagonal - 1
+        previous_x = frontier[previous_diagonal + edits + 1]
+        previous_y = previous_x - previous_diagonal
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            steps.append(('equal', prefix + x, prefix + y))
+        if edits > 0:
+            if x == previous_x:
+                steps.append(('insert', prefix + previous_x, prefix + previous_y))
+            else:
+                steps.append(('delete', prefix + previous_x, prefix + previous_y))
+        x, y = previous_x, previous_y
+    steps.reverse()
+    return ([('equal', position, position) for position in range(prefix)] + steps
+            + [('equal', len(old) - suffix + position, len(new) - suffix + position) for position in range(suffix)])
+
+
+@traced
+def diff_opcodes(old, new):
+    """A function that returns the differences between two lists of lines as
+    (tag, old start, old end, new start, new end) opcodes, like those of difflib,
+    from a Myers diff. Files too different for it fall back to difflib."""
+    steps = myers_diff(old, new)
+    if steps is None:
+        return difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes()
+    runs = []
+    for tag, old_position, new_position in steps:
+        if not runs or runs[-1][0] != (tag == 'equal'):
+            runs.append([tag == 'equal', old_position, old_position, new_position, new_position])
+        if tag != 'insert':
+            runs[-1][2] = old_position + 1
+        if tag != 'delete':
+            runs[-1][4] = new_position + 1
+    opcodes = []
+    for equal, old_start, old_end, new_start, new_end in runs:
+        if equal:
+            tag = 'equal'
+        elif old_start < old_end and new_start < new_end:
+            tag = 'replace'
+        else:
+            tag = 'delete' if old_start < old_end else 'insert'
+        opcodes.append((tag, old_start, old_end, new_start, new_end))
+    return opcodes
+
+
+def group_opcodes(opcodes, context=DIFF_CONTEXT):
+    """A generator that splits opcodes into the hunks of a unified diff, with up to
+    context lines of unchanged lines around each change."""
+    if not opcodes:
+        return
+    opcodes = list(opcodes)
+    tag, old_start, old_end, new_start, new_end = opcodes[0]
+    if tag == 'equal':
+        opcodes[0] = (tag, max(old_start, old_end - context), old_end, max(new_start, new_end - context), new_end)
+    tag, old_start, old_end, new_start, new_end = opcodes[-1]
+    if tag == 'equal':
+        opcodes[-1] = (tag, old_start, min(old_end, old_start + context), new_start, min(new_end, new_start + context))
+    group = []
+    for tag, old_start, old_end, new_start, new_end in opcodes:
+        if tag == 'equal' and old_end - old_start > context * 2:
+            group.append((tag, old_start, min(old_end, old_start + context),
+                          new_start, min(new_end, new_start + context)))
+            yield group
+            group = []
+            old_start, new_start = max(old_start, old_end - context), max(new_start, new_end - context)
+        group.append((tag, old_start, old_end, new_start, new_end))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def format_range(start, end):
+    """A function that formats a range of lines the way a unified diff hunk header does."""
+    beginning = start + 1
+    length = end - start
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def format_lines(sign, lines):
+    """A generator that yields lines of a unified diff, marking a last line without a
+    newline the way git does."""
+    for line in lines:
+        text = line.decode(errors='replace')
+        if text.endswith('\n'):
+            yield f'{sign}{text}'
+        else:
+            yield f'{sign}{text}\n'
+            yield '\\ No newline at end of file\n'
+
+
+def unified_diff(path, old, new):
+    """A generator that yields the lines of the unified diff of a file's old and new
+    content, either of which is None for a missing file."""
+    yield f'diff --wit a/{path} b/{path}\n'
+    if old is None:
+        yield 'new file\n'
+    elif new is None:
+        yield 'deleted file\n'
+    old_content = old or b''
+    new_content = new or b''
+    if b'\0' in old_content or b'\0' in new_content:
+        yield f'Binary files {"a/" + path if old is not None else "/dev/null"} and ' \
+              f'{"b/" + path if new is not None else "/dev/null"} differ\n'
+        return
+    yield f'--- {"a/" + path if old is not None else "/dev/null"}\n'
+    yield f'+++ {"b/" + path if new is not None else "/dev/null"}\n'
+    old_lines = old_content.splitlines(keepends=True)
+    new_lines = new_content.splitlines(keepends=True)
+    for group in group_opcodes(diff_opcodes(old_lines, new_lines)):
+        yield (f'@@ -{format_range(group[0][1], group[-1][2])} '
+               f'+{format_range(group[0][3], group[-1][4])} @@\n')
+        for tag, old_start, old_end, new_start, new_end in group:
+            if tag == 'equal':
+                yield from format_lines(' ', old_lines[old_start:old_end])
+                continue
+            yield from format_lines('-', old_lines[old_start:old_end])
+            yield from format_lines('+', new_lines[new_start:new_end])
+
+
+def working_tree_files(main_backup_dir, index):
+    """A function that returns a dictionary of the tracked files of the working tree
+    and their blob ids. Files whose stat data matches the index keep the index's id,
+    only the others are hashed again."""
+    index_time = index_mtime_ns(main_backup_dir)
+    files = {}
+    for path, entry in index.items():
+        try:
+            stat_result = os.stat(main_backup_dir.parent / path)
+        except FileNotFoundError:
+            continue
+        if is_entry_clean(entry, stat_result, index_time):
+            files[path] = entry.object_id
+        else:
+            files[path] = hash_file(main_backup_dir.parent / path)
+    return files
+
+
+def path_in(path, paths):
+    """A function that checks if a path is one of the paths passed to it or inside
+    one of them. No paths means every path."""
+    return not paths or any(not prefix or path == prefix or path.startswith(f'{prefix}/') for prefix in paths)
+
+
+@traced
+def tree_changes(main_backup_dir, old_tree_id, new_tree_id):
+    """A function that returns a dictionary of every path that differs between two trees
+    and its blob id in the new tree, None for the deleted paths."""
+    added, modified, deleted = compare_trees(main_backup_dir, old_tree_id, new_tree_id)
+    changes = {**added, **modified}
+    changes.update((path, None) for path in deleted)
+    return changes
+
+
+def find_untracked_collisions(root, index, paths):
+    """A function that returns the sorted paths, of those passed to it, that would
+    overwrite something the index does not track: a file at the path, a directory
+    at the path that holds untracked files or no files at all, or a file in place of
+    one of its directories. Ignored files are found too. Tracked files in the way
+    are left out, they are removed by the update that writes the paths."""
+    collisions = set()
+    for path in paths:
+        if path in index:
+            continue
+        if os.path.isdir(root / path) and not os.path.islink(root / path):
+            files = [name for name, _stat_result in walk_files(root, f'{path}/')]
+            if not files or any(name not in index for name in files):
+                collisions.add(path)
+            continue
+        if os.path.lexists(root / path):
+            collisions.add(path)
+            continue
+        for parent in pathlib.PurePosixPath(path).parents:
+            parent = parent.as_posix()
+            if parent != '.' and parent not in index and os.path.lexists(root / parent) \
+                    and not os.path.isdir(root / parent):
+                collisions.add(parent)
+    return sorted(collisions)
+
+
+@traced
+def apply_merge_changes(transaction, main_backup_dir, files, deleted, conflicted):
+    """A function that writes the merged files to the working directory and the index
+    and removes the deleted ones from both. The conflicted files, a dictionary of paths
+    and their content with conflict markers, are written to the working directory only,
+    the index keeps our version of them until they are resolved and added. Returns
+    the new index."""
+    root = main_backup_dir.parent
+    transaction.lock('index')
+    index = read_index(main_backup_dir)
+    remove_files(root, deleted)
+    for path in deleted:
+        index.pop(path, None)
+    index.update(restore_files(main_backup_dir, root, files))
+    for path, content in conflicted.items():
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_bytes(content)
+    write_index(transaction, index)
+    return index
+
+
+def resolve_commit_id(main_backup_dir, name):
+    """A function that takes a branch name, a tag name, 'HEAD' or a commit id and
+    returns the commit id it refers to. Raises a WitError if the name is neither a
+    ref nor the id of a commit."""
+    if name == 'HEAD':
+        return read_head(main_backup_dir)
+    for ref_name in (f'refs/heads/{name}', f'refs/tags/{name}'):
+        commit_id = read_ref(main_backup_dir, ref_name)
+        if commit_id is not None:
+            return commit_id
+    if re.fullmatch('[0-9a-f]{40}', name) and (main_backup_dir / 'images' / f'{name}.txt').is_file():
+        return name
+    raise WitError(f'Unknown revision {name}.')
+
+
+def find_revision_tree(main_backup_dir, revision):
+    """A function that returns the tree id of a revision, or None, the empty tree, for
+    the head before the first commit."""
+    commit_id = resolve_commit_id(main_backup_dir, revision)
+    return None if commit_id is None else find_tree_in_metadata(main_backup_dir, commit_id)
+
+
+def log(repository, revision='HEAD', paths=(), first_parent=False, since=None, limit=None):
+    """A generator that yields the metadata of the commits reachable from a revision,
+    newest first, as dictionaries with the 'commit' id and the 'parent', 'date',
+    'message' and 'tree' of the metadata file. Commits are found by walking the commit
+    graph lazily, so the first ones are yielded at once however long the history is,
+    and only the metadata files of the yielded commits are read. If paths are passed,
+    only the commits that changed them are yielded, the changed-path Bloom filters
+    sparing the tree reads of most of the others. since is a date in ISO format."""
+    main_backup_dir = repository.main_backup_dir
+    commit_id = resolve_commit_id(main_backup_dir, revision)
+    if commit_id is None:
+        return
+    graph = read_commit_graph(main_backup_dir)
+    since_time = None if since is None else int(datetime.fromisoformat(since).timestamp())
+    paths = [pathlib.Path(os.path.abspath(path)).relative_to(repository.root).as_posix() for path in paths]
+    paths = ['' if path == '.' else path for path in paths]
+    blooms = read_bloom_filters(main_backup_dir) if paths else {}
+    count = 0
+    for commit_id in walk_commits(graph, commit_id, first_parent, since_time):
+        if limit is not None and count >= limit:
+            return
+        if paths and not commit_touches_paths(main_backup_dir, graph, commit_id, paths, first_parent, blooms):
+            continue
+        count += 1
+        yield {'commit': commit_id, **read_metadata(main_backup_dir, commit_id)}
+
+
+def print_log(commits, oneline=False):
+    """A function that prints the commits yielded by log as they come."""
+    for metadata in commits:
+        if oneline:
+            print(f'{metadata["commit"][:7]} {metadata["message"]}', flush=True)
+            continue
+        print(f'commit {metadata["commit"]}')
+        parents = metadata['parent'].split(' ,')
+        if len(parents) > 1:
+            print(f'Merge: {" ".join(parent[:7] for parent in parents)}')
+        print(f'Date:   {metadata["date"]}')
+        print(f'\n    {metadata["message"]}\n', flush=True)
+
+
+def diff(repository, old=None, new=None, paths=(), cached=False):
+    """A generator that yields the lines of a unified diff between two sides, which
+    are compared by blob id so only the files that differ are read. With no commits
+    the index is compared to the working tree, with one commit that commit's tree is
+    compared to the working tree and with two their trees are compared. With cached
+    the commit (the head by default) is compared to the index instead. The head is
+    the empty tree before the first commit. Trees are
+    compared with diff_tree_entries, which skips identical subtrees, so diffs between
+    nearby commits are cheap whatever the size of the repository."""
+    main_backup_dir = repository.main_backup_dir
+    root = repository.root
+    paths = [pathlib.Path(os.path.abspath(path)).relative_to(root).as_posix() for path in paths]
+    paths = ['' if path == '.' else path for path in paths]
+    if cached and old is None:
+        old = 'HEAD'
+    old_tree_id = None if old is None else find_revision_tree(main_backup_dir, old)
+    working = not cached and new is None
+    if new is not None:
+        changes = diff_tree_entries(main_backup_dir, old_tree_id, find_revision_tree(main_backup_dir, new))
+    else:
+        index = read_index(main_backup_dir)
+        if old is None:
+            old_files = {path: entry.object_id for path, entry in index.items()}
+        else:
+            old_files = {} if old_tree_id is None else flatten_tree(main_backup_dir, old_tree_id)
+        new_files = working_tree_files(main_backup_dir, index) if working else \
+            {path: entry.object_id for path, entry in index.items()}
+        changes = [(path, old_files.get(path), new_files.get(path))
+                   for path in sorted(old_files.keys() | new_files.keys())
+                   if old_files.get(path) != new_files.get(path)]
+    for path, old_id, new_id in changes:
+        if not path_in(path, paths):
+            continue
+        old_content = None if old_id is None else read_object(main_backup_dir, old_id)
+        if new_id is None:
+            new_content = None
+        elif working:
+            new_content = (root / path).read_bytes()
+        else:
+            new_content = read_object(main_backup_dir, new_id)
+        yield from unified_diff(path, old_content, new_content)
+
+
+def fsmonitor(repository, action):
+    """A function that starts the fsmonitor daemon in the background, stops it, or
+    runs it in the foreground ('start', 'stop' or 'run'). Start returns once the
+    daemon answers queries."""
+    main_backup_dir = repository.main_backup_dir
+    if action == 'stop':
+        query_fsmonitor(main_backup_dir, 'quit')
+        return
+    if query_fsmonitor(main_backup_dir, '') is not None:
+        raise WitError('An fsmonitor daemon is already running.')
+    if action == 'run':
+        FSMonitor(repository).run()
+        return
+    monitor = FSMonitor(repository)
+    if os.fork() == 0:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for descriptor in (0, 1, 2):
+            os.dup2(null, descriptor)
+        try:
+            monitor.run()
+        finally:
+            os._exit(0)
+    os.wait()
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while query_fsmonitor(main_backup_dir, '') is None:
+        if time.monotonic() > deadline:
+            raise WitError('The fsmonitor daemon did not start.')
+        time.sleep(LOCK_RETRY_DELAY)
+
+
+def merge_base(repository, first, second):
+    """A function that takes two branch names or commit ids and returns the
+    ids of their best common ancestors."""
+    main_backup_dir = repository.main_backup_dir
+    graph = read_commit_graph(main_backup_dir)
+    return find_merge_bases(graph, resolve_commit_id(main_backup_dir, first),
+                            resolve_commit_id(main_backup_dir, second))
 
 
 def init():
-    """A function that initializes the main and secondary backup directories."""
+    """A function that initializes the main and secondary backup directories and sets up
+    the activated branch file with a default value of 'master'."""
     main_backup_dir = '.wit'
     parent_dir = os.getcwd()
-    new_dir = pathlib.Path() / parent_dir / main_backup_dir / 'images'  #Changed syntax according to notes on submission
+    new_dir = pathlib.Path() / parent_dir / main_backup_dir / 'images'
     new_dir.mkdir(parents=True, exist_ok=True)
-    new_dir = pathlib.Path() / parent_dir / main_backup_dir / 'staging_area'
+    new_dir = pathlib.Path() / parent_dir / main_backup_dir / 'objects'
     new_dir.mkdir(parents=True, exist_ok=True)
+    with open(new_dir.parent / 'activated.txt', 'w') as activated:
+        activated.write('master')
 
 
-def add(src):
-    """A function that takes a source path and copies the
-    file to a subdirectory (staging area)"""
-    subfolder = 'staging_area'
-    src = pathlib.Path(src)
-    src = src.absolute().resolve()
-    dst = check_backup_dir(subfolder)
-    copy_file_or_dir(src, dst)
-
-
-def commit(message):
-    """A function that commits the content of the staging area to an image folder
-    and generates meta-data files."""
-    images = check_backup_dir('images')
-    main_backup_dir = check_backup_dir()
-    commit_id = ''.join(random.choices(list('1234567890abcdef'), k=40))
-    parent = determine_parent()
-    make_meta_data(images, commit_id, message, parent)
-    shutil.copytree(main_backup_dir / 'staging_area', images / commit_id)
-    # if (main_backup_dir / 'references.txt').exists():
-    with open(main_backup_dir / 'references.txt', 'w') as references:
-        references.write(f'HEAD={commit_id}\n'
-                         f'master commit={commit_id}')
-    # update_master(main_backup_dir, commit_id)  #ask about this!
-
-
-# def update_master(main_backup_dir, commit_id):
-#     with open(main_backup_dir / 'references.txt', 'r') as references:
-#         lines = references.readlines()
-#         print(lines[0])
-#         print(lines[1])
-#         HEAD = lines[0][5:45]
-#         print(HEAD)
-#         master = lines[1][14:54]
-#         print(master)
-#     if HEAD == master:
-#         with open(main_backup_dir / 'references.txt', 'r') as references:
-#             lines = references.readlines()
-#             lines[1] = f'master commit={HEAD}\n'
-#         with open(main_backup_dir / 'references.txt', 'w') as references:
-#             references.writelines(lines)
-
-
-
-
-
-
-def status():
-    """A function that prints out data on the state of the changes not yet committed."""
-    backup_dir = check_backup_dir()
-    with open(backup_dir / 'references.txt', 'r') as references:
-        recent_commit_id = references.readlines()[0][5:45]
-    recent_backup_dir = backup_dir / 'images' / recent_commit_id
-    staging_area = backup_dir / 'staging_area'
-    current_dir = os.getcwd()
-    staging_vs_recent_commit = filecmp.dircmp(staging_area, recent_backup_dir)
-    staging_vs_cwd = filecmp.dircmp(staging_area, current_dir)
-    stat = {'Most recent commit id': recent_commit_id,
-            'Changes to be committed': staging_vs_recent_commit.left_only,
-            'Changes not staged for commit': staging_vs_cwd.diff_files,
-            'Untracked files': staging_vs_cwd.right_only}
-    return stat
-
-
-def checkout(commit_id):
-    """A function that takes an image directory id and replaces the contents of the cwd
-    with the contents of that image directory."""
-    if commit_id == 'master':
-        main_backup_dir = check_backup_dir()
-        with open(main_backup_dir / 'references.txt', 'r') as references:
-            commit_id = references.readlines()[1][14:54]
-    images = check_backup_dir('images')
-    staging_area = check_backup_dir('staging_area')
-    image_dir = images / commit_id
-    current_dir = os.getcwd()
-    current_dir = pathlib.Path(current_dir)
-    stat = status()
-    if stat['Changes to be committed'] != [] or stat['Changes not staged for commit'] != []:
-        print('Unsaved changes detected, please check your work and commit changes.')
-        for key in stat:
-            print(f'{key}: {stat[key]}')
-        return stat
-    image_files = os.listdir(image_dir)
-    for file in image_files:
-        if file not in stat['Untracked files']:
-            copy_file_or_dir(image_dir / file, current_dir / file)
-    replace_dir_content(staging_area, image_dir)
-    update_head(staging_area.parent, commit_id)
+def stage_file(main_backup_dir, path, stat_result, methods, chunk_threshold):
+    """A function that stores a working file in the object store and returns its
+    path with the index entry recording it."""
+    object_id = store_blob(main_backup_dir, main_backup_dir.parent / path, methods, chunk_threshold)
+    return path, make_index_entry(object_id, stat_result)
 
 
+@traced
+def add(repository, src=None, jobs=None):
+    """A function that takes a source path, stores the file or the files of the
+    directory in the object store and records them in the index (staging area).
+    Without a source path every change of the working tree is staged, deleted files
+    included, and only the changed files are examined when an fsmonitor daemon runs.
+    Untracked files matched by '.witignore' are not added from directories.
+    Files are hashed and stored on a pool of 'jobs' threads (the number of CPUs
+    by default) and recorded in the index as they finish. Files whose stat data
+    did not change since they were staged are not read again. The index is only
+    locked once all the files are stored."""
+    main_backup_dir = repository.main_backup_dir
+    root = repository.root
+    deleted = []
+    if src is None:
+        modified, deleted, untracked = compare_index_to_working_tree(main_backup_dir, read_index(main_backup_dir))
+        files = [(path, os.stat(root / path)) for path in modified + untracked]
+    else:
+        src = pathlib.Path(src).absolute().resolve()
+        relative_src = src.relative_to(root).as_posix()
+        if src.is_dir():
+            prefix = '' if src == root else f'{relative_src}/'
+            files = [(path, stat_result) for path, stat_result in
+                     walk_working_tree(root, read_index(main_backup_dir), prefix).items() if stat_result is not None]
+        else:
+            files = [(relative_src, os.stat(src))]
+    index = read_index(main_backup_dir)
+    index_time = index_mtime_ns(main_backup_dir)
+    methods = materialize_methods(main_backup_dir, allow_hardlink=False)
+    chunk_threshold = int(read_config(main_backup_dir).get('chunk_threshold', CHUNK_THRESHOLD))
+    staged = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = []
+        for path, stat_result in files:
+            entry = index.get(path)
+            if entry is not None and is_entry_clean(entry, stat_result, index_time):
+                continue
+            futures.append(executor.submit(stage_file, main_backup_dir, path, stat_result, methods,
+                                           chunk_threshold))
+        for future in concurrent.futures.as_completed(futures):
+            path, entry = future.result()
+            staged[path] = entry
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('index')
+        index = read_index(main_backup_dir)
+        index.update(staged)
+        for path in deleted:
+            index.pop(path, None)
+        write_index(transaction, index)
 
 
-if __name__ == '__main__':
-    if sys.argv[1] == 'init':
+@traced
+def commit(repository, message, merge_parent=None):
+    """A function that commits the content of the staging area to the object store
+    and generates meta-data files. Only blobs that are not stored yet are written.
+    If a merge parent is passed, or a merge with conflicts left one in MERGE_HEAD,
+    it is recorded as the second parent of the commit.
+    The head and the active branch are locked while the commit is made, and the
+    commit's tree objects and metadata file are flushed to disk, as its blobs were
+    when they were added, before the refs are moved to it. A Bloom filter of the
+    paths changed from the first parent is kept for path-limited log queries.
+    Returns the commit id for use in merge operations."""
+    with Transaction(repository.main_backup_dir) as transaction:
+        return commit_index(transaction, message, merge_parent)
+
+
+def commit_index(transaction, message, merge_parent=None, index=None):
+    """A function that makes the commit of the commit function as part of a
+    transaction, which locks the head, the active branch and MERGE_HEAD until it
+    ends. The index passed to it is committed, or the index file if none is passed,
+    so a caller that changed the index in the same transaction commits its changes
+    before they are written. Returns the commit id."""
+    main_backup_dir = transaction.main_backup_dir
+    transaction.lock('activated.txt')
+    transaction.lock('HEAD')
+    transaction.lock(f'refs/heads/{read_active_branch(main_backup_dir)}')
+    transaction.lock('MERGE_HEAD')
+    parent = determine_parent(main_backup_dir)
+    merge_head = main_backup_dir / 'MERGE_HEAD'
+    if merge_parent is None and merge_head.exists():
+        merge_parent = merge_head.read_text().strip()
+    if merge_head.exists():
+        transaction.delete('MERGE_HEAD')
+    if merge_parent is not None:
+        parent = f'{parent} ,{merge_parent}'
+    tree_id = write_index_tree(main_backup_dir, read_index(main_backup_dir) if index is None else index)
+    now = datetime.now()
+    commit_id = make_meta_data(main_backup_dir / 'images', message, parent, tree_id, now)
+    parents = [] if parent == 'None' else parent.split(' ,')
+    append_to_commit_graph(transaction, commit_id, parents, int(now.timestamp()))
+    parent_tree_id = find_tree_in_metadata(main_backup_dir, parents[0]) if parents else None
+    append_bloom_filters(transaction, {commit_id: changed_paths(main_backup_dir, parent_tree_id, tree_id)})
+    update_references(transaction, parents[0] if parents else 'None', commit_id)
+    return commit_id
+
+
+@traced
+def read_status(repository):
+    """A function that returns the Status of the changes not yet committed.
+    Staged changes are found by comparing the blob ids in the index with the most
+    recent commit, and the working tree is compared to the index in a single walk.
+    All paths are full paths relative to the repository root."""
+    backup_dir = repository.main_backup_dir
+    recent_commit_id = read_head(backup_dir)
+    committed = {}
+    if recent_commit_id is not None:
+        committed = flatten_tree(backup_dir, find_tree_in_metadata(backup_dir, recent_commit_id))
+    index = read_index(backup_dir)
+    staged = {path: entry.object_id for path, entry in index.items()}
+    not_staged_modified, not_staged_deleted, untracked = compare_index_to_working_tree(backup_dir, index)
+    return Status(recent_commit_id, Changes(*compare_files(committed, staged)),
+                  Changes([], not_staged_modified, not_staged_deleted), untracked)
+
+
+def status(repository):
+    """A function that returns the data on the state of the changes not yet committed
+    as the dictionary printed by 'wit status'."""
+    stat = read_status(repository)
+    return {'Most recent commit id': stat.head or 'None',
+            'Changes to be committed': describe_changes(*stat.staged),
+            'Changes not staged for commit': describe_changes(*stat.unstaged),
+            'Untracked files': stat.untracked}
+
+
+@traced
+def update_working_tree(transaction, repository, head_id, commit_id):
+    """A function that moves the working directory and the index from the head's tree
+    to the tree of the commit passed to it. Only the paths that differ between the
+    two trees are written or deleted. The index must be locked by the transaction.
+    Unsaved changes, and untracked or ignored files that a written path would
+    overwrite, stop the update with a WitError before anything is touched."""
+    main_backup_dir = repository.main_backup_dir
+    head_tree_id = None if head_id == 'None' else find_tree_in_metadata(main_backup_dir, head_id)
+    target_tree_id = find_tree_in_metadata(main_backup_dir, commit_id)
+    added, modified, deleted = compare_trees(main_backup_dir, head_tree_id, target_tree_id)
+    current_dir = repository.root
+    check_status(status(repository))
+    index = read_index(main_backup_dir)
+    untracked = find_untracked_collisions(current_dir, index, [*added, *modified])
+    if untracked:
+        raise WitError(f'Untracked files would be overwritten: {", ".join(untracked)}. '
+                       'Please move or remove them and try again.')
+    remove_files(current_dir, deleted)
+    for path in deleted:
+        index.pop(path, None)
+    index.update(restore_files(main_backup_dir, current_dir, {**added, **modified}))
+    write_index(transaction, index)
+
+
+@traced
+def checkout(repository, user_input):
+    """A function that takes either a commit id or branch name. If a branch name is passed
+    it is updated in the 'activated' file and its associated commit id is used. If a commit id
+    is passed, that will be the commit id used. the function compares the tree of the head
+    with the tree of that commit and only writes and deletes the paths that differ, in the
+    cwd and in the index. The head, the activated branch and the index stay locked
+    until the working directory is updated. Returns the commit id."""
+    main_backup_dir = repository.main_backup_dir
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('activated.txt')
+        transaction.lock('HEAD')
+        transaction.lock('index')
+        branch_id = read_ref(main_backup_dir, f'refs/heads/{user_input}')
+        commit_id = branch_id or resolve_commit_id(main_backup_dir, user_input)
+        update_working_tree(transaction, repository, determine_parent(main_backup_dir), commit_id)
+        if branch_id is not None:
+            transaction.write('activated.txt', user_input)
+        update_head(transaction, commit_id)
+    return commit_id
+
+
+@traced
+def branch(repository, name):
+    """A function that creates a new branch ref pointing at the head commit and
+    returns its commit id. Raises a WitError before the first commit."""
+    main_backup_dir = repository.main_backup_dir
+    head_id = read_head(main_backup_dir)
+    if head_id is None:
+        raise WitError(f'Can not create branch {name} before the first commit.')
+    with Transaction(main_backup_dir) as transaction:
+        write_ref(transaction, f'refs/heads/{name}', head_id)
+    return head_id
+
+
+@traced
+def tag(repository, name, commit_id=None):
+    """A function that creates a tag ref pointing at a commit, the head by default.
+    Raises a WitError if no commit is passed before the first commit."""
+    main_backup_dir = repository.main_backup_dir
+    target = read_head(main_backup_dir) if commit_id is None else resolve_commit_id(main_backup_dir, commit_id)
+    if target is None:
+        raise WitError(f'Can not create tag {name} before the first commit.')
+    with Transaction(main_backup_dir) as transaction:
+        write_ref(transaction, f'refs/tags/{name}', target)
+
+
+@traced
+def fast_forward(repository, head_id, commit_id):
+    """A function that moves the head, and the active branch if it points at the head,
+    forward to a commit that descends from the head, updating the working directory
+    incrementally as checkout does. Like checkout it raises a WitError before anything
+    is written if the update would overwrite untracked or ignored files."""
+    main_backup_dir = repository.main_backup_dir
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('activated.txt')
+        transaction.lock('HEAD')
+        transaction.lock(f'refs/heads/{read_active_branch(main_backup_dir)}')
+        transaction.lock('index')
+        if read_head(main_backup_dir) != head_id:
+            raise WitError('The head moved while merging, please try again.')
+        update_working_tree(transaction, repository, head_id, commit_id)
+        update_references(transaction, head_id, commit_id)
+
+
+@traced
+def merge(repository, branch_name):
+    """A function that makes a three-way merge of the branch into the head using the
+    tree of their merge base. Paths changed on one side only are resolved by comparing
+    blob ids without reading any content, and only the files changed on both sides are
+    merged line by line. Without conflicts the result is committed with the branch as
+    the second parent. Otherwise the conflicted files are left with conflict markers in
+    the working directory, as are the files we deleted and they changed with their
+    content, the branch is recorded in MERGE_HEAD for the next commit and the list of
+    conflicted paths is returned. If the head is an ancestor of the branch the merge
+    is a fast-forward, no commit is made and only the refs, the index and the paths
+    that differ in the working directory are moved to the branch. Either way a
+    WitError is raised before anything is written if a path would overwrite an
+    untracked or ignored file. The head, the active branch, the index and MERGE_HEAD
+    stay locked from the moment the merge is computed until it is committed, and a
+    WitError is raised if another process moved the head since the merge began."""
+    main_backup_dir = repository.main_backup_dir
+    branch_id = resolve_commit_id(main_backup_dir, branch_name)
+    head_id = read_head(main_backup_dir)
+    graph = read_commit_graph(main_backup_dir)
+    if is_ancestor(graph, branch_id, head_id):
+        return []
+    if is_ancestor(graph, head_id, branch_id):
+        fast_forward(repository, head_id, branch_id)
+        return []
+    with Transaction(main_backup_dir) as transaction:
+        transaction.lock('activated.txt')
+        transaction.lock('HEAD')
+        transaction.lock(f'refs/heads/{read_active_branch(main_backup_dir)}')
+        transaction.lock('index')
+        transaction.lock('MERGE_HEAD')
+        if read_head(main_backup_dir) != head_id:
+            raise WitError('The head moved while merging, please try again.')
+        check_status(status(repository))
+        files, deleted, conflicted, conflicts = merge_trees(main_backup_dir, graph, head_id, branch_id, branch_name)
+        untracked = find_untracked_collisions(repository.root, read_index(main_backup_dir), [*files, *conflicted])
+        if untracked:
+            raise WitError(f'The merge would overwrite untracked files: {", ".join(untracked)}. '
+                           'Please move or remove them and merge again.')
+        index = apply_merge_changes(transaction, main_backup_dir, files, deleted, conflicted)
+        if conflicts:
+            transaction.write('MERGE_HEAD', branch_id)
+            return conflicts
+        commit_index(transaction, f'Commit for merge with {branch_name}', branch_id, index)
+    return []
+
+
+def merge_trees(main_backup_dir, graph, head_id, branch_id, branch_name):
+    """A function that makes the three-way merge of the merge function without
+    touching the working directory or the index. Returns a dictionary of the paths
+    to write and their blob ids, the list of paths to delete, a dictionary of the
+    paths to leave in the working directory only and their content, and the sorted
+    list of conflicted paths."""
+    merge_bases = find_merge_bases(graph, head_id, branch_id)
+    base_tree_id = find_tree_in_metadata(main_backup_dir, merge_bases[0]) if merge_bases else None
+    head_tree_id = find_tree_in_metadata(main_backup_dir, head_id)
+    branch_tree_id = find_tree_in_metadata(main_backup_dir, branch_id)
+    ours = tree_changes(main_backup_dir, base_tree_id, head_tree_id)
+    theirs = tree_changes(main_backup_dir, base_tree_id, branch_tree_id)
+    files = {}
+    deleted = []
+    conflicted = {}
+    conflicts = []
+    for path, theirs_id in sorted(theirs.items()):
+        if path not in ours:
+            if theirs_id is None:
+                deleted.append(path)
+            else:
+                files[path] = theirs_id
+        elif ours[path] == theirs_id:
+            continue
+        elif ours[path] is None or theirs_id is None:
+            if theirs_id is not None:
+                conflicted[path] = read_object(main_backup_dir, theirs_id)
+            conflicts.append(path)
+        else:
+            base_id = None if base_tree_id is None else find_blob_in_tree(main_backup_dir, base_tree_id, path)
+            content, conflict = merge_blobs(main_backup_dir, base_id, ours[path], theirs_id, branch_name)
+            if conflict:
+                conflicted[path] = content
+                conflicts.append(path)
+            else:
+                files[path] = store_object(main_backup_dir, content)
+    return files, deleted, conflicted, conflicts
+
+
+def split_paths(args):
+    """A function that splits command line arguments at '--' and returns the
+    arguments before it and the paths after it."""
+    if '--' not in args:
+        return args, []
+    return args[:args.index('--')], args[args.index('--') + 1:]
+
+
+def run_command(repository, command, args):
+    """A function that runs a wit command with its command line arguments and
+    returns its result instead of printing it. The results of log and diff are
+    generators, so they can be printed as they are produced. The '--oneline' flag
+    of log only changes how the result is printed and is left to the caller."""
+    args = list(args)
+    if command == 'add':
+        jobs = pop_option(args, '--jobs')
+        return add(repository, None if pop_flag(args, '-A') else args[0], None if jobs is None else int(jobs))
+    if command == 'commit':
+        return commit(repository, args[0])
+    if command == 'status':
+        return status(repository)
+    if command == 'checkout':
+        return checkout(repository, args[0])
+    if command == 'branch':
+        return branch(repository, args[0])
+    if command == 'merge':
+        return merge(repository, args[0])
+    if command == 'log':
+        args, paths = split_paths(args)
+        limit = pop_option(args, '-n')
+        since = pop_option(args, '--since')
+        first_parent = pop_flag(args, '--first-parent')
+        pop_flag(args, '--oneline')
+        return log(repository, args[0] if args else 'HEAD', paths, first_parent, since,
+                   None if limit is None else int(limit))
+    if command == 'diff':
+        args, paths = split_paths(args)
+        cached = pop_flag(args, '--cached')
+        return diff(repository, *args[:2], paths=paths, cached=cached)
+    if command == 'fsmonitor':
+        return fsmonitor(repository, args[0])
+    if command == 'merge-base':
+        return merge_base(repository, args[0], args[1])
+    if command == 'tag':
+        return tag(repository, *args[:2])
+    if command == 'pack-refs':
+        return pack_refs(repository)
+    if command == 'gc':
+        return gc(repository)
+    if command == 'repack':
+        return repack(repository)
+    if command == 'config':
+        return set_config(repository, args[0], args[1])
+    raise ValueError(f'Unknown command {command}.')
+
+
+def batch(repository, input_file, output_file):
+    """A function that runs the commands read from the input file, one command line
+    without the 'wit' prefix per line, and writes one JSON line per command to the
+    output file: {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+    The repository is discovered once and the parsed index, commit graph, Bloom
+    filters, tree ids and packs stay cached between the commands. The cached files
+    are checked by their stat data, so changes made by other processes are seen.
+    Anything the commands print goes to stderr."""
+    for line in input_file:
+        try:
+            args = shlex.split(line)
+            if not args:
+                continue
+            with contextlib.redirect_stdout(sys.stderr), trace_span(f'wit {args[0]}', argv=args):
+                result = run_command(repository, args[0], args[1:])
+                if args[0] == 'diff':
+                    result = ''.join(result)
+                elif args[0] == 'log':
+                    result = list(result)
+            response = {'ok': True, 'result': result}
+        except Exception as error:
+            response = {'ok': False, 'error': str(error)}
+        output_file.write(json.dumps(response) + '\n')
+        output_file.flush()
+
+
+def main(argv):
+    """A function that runs the wit command line. The '--trace <path>' option before
+    the command, like the WIT_TRACE environment variable, writes a trace of the spans
+    of the command to the path."""
+    if argv[0] == '--trace':
+        start_tracing(argv[1])
+        argv = argv[2:]
+    command = argv[0]
+    args = argv[1:]
+    if command == 'init':
         init()
-    if sys.argv[1] == 'add':
-        add(sys.argv[2])
-    if sys.argv[1] == 'commit':
-        commit(sys.argv[2])
-    if sys.argv[1] == 'status':
-        stat = status()
-        for key in stat:
-            print(f'{key}: {stat[key]}')
-    # if sys.argv[1] == 'wit_rm':
-    #     wit_rm(sys.argv[2])
-    if sys.argv[1] == 'checkout':
-        checkout(sys.argv[2])
\ No newline at end of file
+    elif command == '--batch':
+        batch(Repository.discover(), sys.stdin, sys.stdout)
+    else:
+        with trace_span(f'wit {command}', argv=args):
+            run_main_command(command, args)
+
+
+def run_main_command(command, args):
+    """A function that runs a single command of the command line and prints its result."""
+    oneline = '--oneline' in args
+    try:
+        result = run_command(Repository.discover(), command, args)
+    except UnsavedChangesError as error:
+        print_dict(error.status)
+        raise
+    try:
+        if command == 'status':
+            print_dict(result)
+        if command == 'merge':
+            for path in result:
+                print(f'Merge conflict in {path}')
+        if command == 'log':
+            print_log(result, oneline)
+        if command == 'diff':
+            for line in result:
+                sys.stdout.write(line)
+        if command == 'merge-base':
+            for base_id in result:
+                print(base_id)
+        if command in ('gc', 'repack'):
+            print(f'Packed {result[0]} objects, {result[1]} as deltas.')
+    except BrokenPipeError:
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,694 @@
+import io
+import pathlib
+import random
+import subprocess
+import sys
+
+import pytest
+
+import wit
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    """A fixture that initializes an empty repository in a temp directory and makes
+    it the cwd."""
+    monkeypatch.chdir(tmp_path)
+    wit.init()
+    return wit.Repository.open()
+
+
+def write(repository, path, content):
+    """A function that writes a working file, creating its directories."""
+    file_path = pathlib.Path(repository.root) / path
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_text(content)
+
+
+def read(repository, path):
+    """A function that returns the content of a working file."""
+    return (pathlib.Path(repository.root) / path).read_text()
+
+
+def test_status_tracked_file_replaced_by_directory(repository):
+    write(repository, 'x', '1\n')
+    repository.add('x')
+    repository.commit('file')
+    (repository.root / 'x').unlink()
+    write(repository, 'x/y', '2\n')
+    status = repository.status()
+    assert status.unstaged.deleted == ['x']
+    assert status.untracked == ['x/y']
+    repository.add()
+    assert repository.status().staged == wit.Changes(['x/y'], [], ['x'])
+
+
+def test_status_tracked_directory_replaced_by_file(repository):
+    write(repository, 'x/y', '1\n')
+    repository.add('x')
+    repository.commit('directory')
+    (repository.root / 'x' / 'y').unlink()
+    (repository.root / 'x').rmdir()
+    write(repository, 'x', '2\n')
+    status = repository.status()
+    assert status.unstaged.deleted == ['x/y']
+    assert status.untracked == ['x']
+
+
+def test_merge_refuses_to_overwrite_untracked_files(repository):
+    write(repository, 'a.txt', 'base\n')
+    repository.add('a.txt')
+    repository.commit('base')
+    repository.branch('feat')
+    repository.checkout('feat')
+    write(repository, 'new.txt', 'theirs\n')
+    repository.add('new.txt')
+    repository.commit('add new.txt')
+    repository.checkout('master')
+    write(repository, 'b.txt', 'ours\n')
+    repository.add('b.txt')
+    head = repository.commit('ours')
+    write(repository, 'new.txt', 'untracked\n')
+    with pytest.raises(wit.WitError, match='new.txt'):
+        repository.merge('feat')
+    assert read(repository, 'new.txt') == 'untracked\n'
+    assert repository.status().head == head.id
+
+
+def make_old_repository(root):
+    """A function that lays out a repository the way the first wit wrote it, with a
+    full copy of every commit in images/<commit id>, the staging area in staging_area
+    and the refs in references.txt. Returns the two commit ids."""
+    images = root / '.wit' / 'images'
+    first, second = 'a' * 40, 'b' * 40
+    for commit_id, parent, files in [(first, 'None', {'a.txt': 'one\n'}),
+                                     (second, first, {'a.txt': 'two\n', 'b.txt': 'b\n'})]:
+        (images / commit_id).mkdir(parents=True)
+        for name, content in files.items():
+            (images / commit_id / name).write_text(content)
+        (images / f'{commit_id}.txt').write_text(f'parent={parent}\ndate=Sat Oct 17 07:00:00 2026 +0300\n'
+                                                 f'message={commit_id[0]}\n')
+    (root / '.wit' / 'staging_area').mkdir()
+    for name, content in {'a.txt': 'two\n', 'b.txt': 'b\n', 'c.txt': 'c\n'}.items():
+        (root / '.wit' / 'staging_area' / name).write_text(content)
+        (root / name).write_text(content)
+    (root / '.wit' / 'references.txt').write_text(f'HEAD={second}\nmaster commit={second}')
+    return first, second
+
+
+def test_old_repository_is_migrated_when_opened(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first, second = make_old_repository(tmp_path)
+    repository = wit.Repository.open()
+    backup_dir = repository.main_backup_dir
+    assert sorted(path.name for path in backup_dir.iterdir()) == ['HEAD', 'activated.txt', 'images', 'index',
+                                                                  'objects', 'refs']
+    assert sorted(path.name for path in (backup_dir / 'images').iterdir()) == [f'{first}.txt', f'{second}.txt']
+    status = repository.status()
+    assert status.head == second
+    assert status.staged == wit.Changes(['c.txt'], [], [])
+    assert status.unstaged == wit.Changes([], [], [])
+    third = repository.commit('three')
+    assert third.parents == (second,)
+    assert [commit.message for commit in repository.log()] == ['three', 'b', 'a']
+    repository.checkout(first)
+    assert read(repository, 'a.txt') == 'one\n'
+    assert not (repository.root / 'b.txt').exists()
+    assert repository.checkout('master') == third
+
+
+def test_failed_migration_leaves_the_old_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first, second = make_old_repository(tmp_path)
+    backup_dir = tmp_path / '.wit'
+
+    def fail(main_backup_dir, directory):
+        raise OSError('disk full')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(wit, 'store_directory', fail)
+        with pytest.raises(OSError, match='disk full'):
+            wit.Repository.open()
+    assert (backup_dir / 'references.txt').read_text() == f'HEAD={second}\nmaster commit={second}'
+    assert (backup_dir / 'images' / first / 'a.txt').exists()
+    assert (backup_dir / 'staging_area').is_dir()
+    assert not (backup_dir / 'HEAD').exists()
+    assert not list(backup_dir.glob('*.lock'))
+    assert wit.Repository.open().status().head == second
+
+
+def test_branch_and_tag_need_a_commit(repository):
+    for run in (lambda: repository.branch('feat'), lambda: wit.tag(repository, 'v1')):
+        with pytest.raises(wit.WitError, match='before the first commit'):
+            run()
+    assert wit.list_refs(repository.main_backup_dir) == {}
+
+
+def test_add_jobs_with_duplicate_chunked_content(repository):
+    wit.set_config(repository, 'chunk_threshold', '1000')
+    content = bytes(range(256)) * 2400
+    for number in range(200):
+        (repository.root / f'{number}.bin').write_bytes(content)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        repository.add('.', jobs=16)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    first = repository.commit('duplicates')
+    status = repository.status()
+    assert status.staged == status.unstaged == wit.Changes([], [], [])
+    assert not list((repository.main_backup_dir / 'objects').glob('*/*.tmp'))
+    (repository.root / '7.bin').unlink()
+    repository.add()
+    repository.commit('delete 7.bin')
+    repository.checkout(first.id)
+    assert (repository.root / '7.bin').read_bytes() == content
+
+
+def test_stored_blob_matches_its_id_when_the_file_changes(repository, monkeypatch):
+    write(repository, 'a.txt', 'before\n')
+    copy_with_methods = wit.copy_with_methods
+
+    def edit_then_copy(src, dst, methods):
+        pathlib.Path(src).write_text('after\n')
+        copy_with_methods(src, dst, methods)
+
+    monkeypatch.setattr(wit, 'copy_with_methods', edit_then_copy)
+    object_id = wit.store_blob(repository.main_backup_dir, repository.root / 'a.txt')
+    assert wit.read_object(repository.main_backup_dir, object_id) == b'after\n'
+    assert wit.hashlib.sha1(b'after\n').hexdigest() == object_id
+    assert not list((repository.main_backup_dir / 'objects').glob('*.tmp'))
+
+
+def test_chunks_survive_an_insert_in_text(repository):
+    words = [f'word{number}' for number in range(1000)]
+    generator = random.Random(5)
+    text = ' '.join(generator.choice(words) for _ in range(1000000)).encode()
+    chunks = list(wit.iter_chunks(io.BytesIO(text)))
+    edited = list(wit.iter_chunks(io.BytesIO(b'x' + text)))
+    assert b''.join(chunks) == text
+    assert len(chunks) > 3
+    assert len(set(chunks) & set(edited)) >= len(chunks) - 2
+
+
+def test_old_references_file_is_migrated_when_opened(repository):
+    write(repository, 'a.txt', 'one\n')
+    repository.add('a.txt')
+    first = repository.commit('one')
+    backup_dir = repository.main_backup_dir
+    (backup_dir / 'HEAD').unlink()
+    (backup_dir / 'refs' / 'heads' / 'master').unlink()
+    (backup_dir / 'references.txt').write_text(f'HEAD={first.id}\nmaster commit={first.id}\n')
+    repository = wit.Repository.open()
+    assert not (backup_dir / 'references.txt').exists()
+    write(repository, 'a.txt', 'two\n')
+    repository.add('a.txt')
+    second = repository.commit('two')
+    assert second.parents == (first.id,)
+    assert wit.read_ref(backup_dir, 'refs/heads/master') == second.id
+
+
+def test_api_paths_are_relative_to_the_root(repository, tmp_path_factory, monkeypatch):
+    write(repository, 'f.txt', 'f\n')
+    write(repository, 'g.txt', 'one\n')
+    repository.add('.')
+    first = repository.commit('one')
+    assert repository.branch('old') == first
+    write(repository, 'g.txt', 'two\n')
+    repository.add('g.txt')
+    second = repository.commit('two')
+    monkeypatch.chdir(tmp_path_factory.mktemp('elsewhere'))
+    repository = wit.Repository.open(repository.root)
+    assert [commit.id for commit in repository.log(paths=['g.txt'])] == [second.id, first.id]
+    assert [commit.id for commit in repository.log(paths=['f.txt'])] == [first.id]
+    diff = ''.join(repository.diff(first.id, second.id, paths=['g.txt']))
+    assert '-one\n+two\n' in diff
+    assert repository.checkout('old') == first
+    assert read(repository, 'g.txt') == 'one\n'
+
+
+def test_objects_are_flushed_before_refs_move(repository, monkeypatch):
+    synced = []
+    monkeypatch.setattr(wit, 'sync_file', lambda path: synced.append(pathlib.Path(path)))
+    write(repository, 'dir/a.txt', 'a\n')
+    repository.add('dir')
+    blobs = set(synced)
+    commit = repository.commit('one')
+    backup_dir = repository.main_backup_dir
+    objects = {path for path in (backup_dir / 'objects').glob('*/*') if not path.name.endswith('.tmp')}
+    assert objects <= set(synced)
+    assert wit.object_path(backup_dir, commit.tree) in set(synced) - blobs
+    assert backup_dir / 'images' / f'{commit.id}.txt' in synced
+    assert not wit.UNSYNCED_FILES
+
+
+def test_unknown_revisions_raise_wit_error(repository):
+    write(repository, 'a.txt', 'a\n')
+    repository.add('a.txt')
+    commit = repository.commit('one')
+    for run in (lambda: repository.merge('nosuch'), lambda: list(repository.log('nosuch')),
+                lambda: repository.checkout('nosuch'), lambda: wit.merge_base(repository, 'master', 'nosuch')):
+        with pytest.raises(wit.WitError, match='Unknown revision nosuch'):
+            run()
+    assert wit.resolve_commit_id(repository.main_backup_dir, commit.id) == commit.id
+
+
+def commit_files(repository, message, files):
+    """A function that writes a dictionary of paths and contents, stages every change
+    of the working tree and commits it."""
+    for path, content in files.items():
+        write(repository, path, content)
+    repository.add()
+    return repository.commit(message)
+
+
+def test_merge_combines_changes_from_both_sides(repository):
+    lines = [f'line {number}\n' for number in range(10)]
+    commit_files(repository, 'base', {'a.txt': ''.join(lines), 'gone.txt': 'gone\n'})
+    repository.branch('feat')
+    lines[1] = 'ours\n'
+    ours = commit_files(repository, 'ours', {'a.txt': ''.join(lines), 'ours.txt': 'ours\n'})
+    repository.checkout('feat')
+    (repository.root / 'gone.txt').unlink()
+    theirs_lines = [f'line {number}\n' for number in range(10)]
+    theirs_lines[8] = 'theirs\n'
+    theirs = commit_files(repository, 'theirs', {'a.txt': ''.join(theirs_lines)})
+    repository.checkout('master')
+    result = repository.merge('feat')
+    assert result.conflicts == []
+    merged = wit.read_commit(repository.main_backup_dir, result.commit_id)
+    assert merged.parents == (ours.id, theirs.id)
+    lines[8] = 'theirs\n'
+    assert read(repository, 'a.txt') == ''.join(lines)
+    assert read(repository, 'ours.txt') == 'ours\n'
+    assert not (repository.root / 'gone.txt').exists()
+    status = repository.status()
+    assert status.staged == status.unstaged == wit.Changes([], [], [])
+
+
+def make_diverged_branches(repository):
+    """A function that makes a master and a feat branch that changed different
+    files since their base, and checks master out."""
+    commit_files(repository, 'base', {'a.txt': 'a\n'})
+    repository.branch('feat')
+    commit_files(repository, 'ours', {'ours.txt': 'ours\n'})
+    repository.checkout('feat')
+    commit_files(repository, 'theirs', {'theirs.txt': 'theirs\n'})
+    repository.checkout('master')
+
+
+def test_merge_holds_the_refs_until_it_is_committed(repository, monkeypatch):
+    make_diverged_branches(repository)
+    merge_trees = wit.merge_trees
+    locked = []
+
+    def check_locks(*args):
+        other = wit.Transaction(repository.main_backup_dir)
+        locked.extend(not other.lock(name, wait=False) for name in ('HEAD', 'refs/heads/master', 'index'))
+        other.rollback()
+        return merge_trees(*args)
+
+    monkeypatch.setattr(wit, 'merge_trees', check_locks)
+    result = repository.merge('feat')
+    assert locked == [True, True, True]
+    assert wit.read_commit(repository.main_backup_dir, result.commit_id).message == 'Commit for merge with feat'
+
+
+def test_merge_fails_if_the_head_moves(repository, monkeypatch):
+    make_diverged_branches(repository)
+    read_commit_graph = wit.read_commit_graph
+    moved = []
+
+    def commit_meanwhile(main_backup_dir):
+        if not moved:
+            moved.append(None)
+            moved[0] = commit_files(wit.Repository.open(), 'meanwhile', {'other.txt': 'other\n'})
+        return read_commit_graph(main_backup_dir)
+
+    monkeypatch.setattr(wit, 'read_commit_graph', commit_meanwhile)
+    with pytest.raises(wit.WitError, match='The head moved'):
+        repository.merge('feat')
+    monkeypatch.undo()
+    assert repository.status().head == moved[0].id
+    assert not (repository.root / 'theirs.txt').exists()
+    assert not list(repository.main_backup_dir.glob('**/*.lock'))
+
+
+def test_merge_keeps_their_edit_of_a_file_we_deleted(repository):
+    commit_files(repository, 'base', {'a.txt': 'base\n', 'dir/b.txt': 'b\n'})
+    repository.branch('feat')
+    (repository.root / 'a.txt').unlink()
+    (repository.root / 'dir/b.txt').unlink()
+    commit_files(repository, 'ours', {})
+    repository.checkout('feat')
+    theirs = commit_files(repository, 'theirs', {'a.txt': 'theirs\n', 'dir/b.txt': 'b2\n'})
+    repository.checkout('master')
+    assert repository.merge('feat') == wit.MergeResult(None, ['a.txt', 'dir/b.txt'])
+    assert read(repository, 'a.txt') == 'theirs\n'
+    assert read(repository, 'dir/b.txt') == 'b2\n'
+    assert repository.status().untracked == ['a.txt', 'dir/b.txt']
+    repository.add('a.txt')
+    resolved = repository.commit('keep a.txt')
+    assert resolved.parents[1] == theirs.id
+    assert wit.flatten_tree(repository.main_backup_dir, resolved.tree).keys() == {'a.txt'}
+
+
+def test_merge_conflict_leaves_markers_until_committed(repository):
+    commit_files(repository, 'base', {'a.txt': 'one\ntwo\nthree\n'})
+    repository.branch('feat')
+    ours = commit_files(repository, 'ours', {'a.txt': 'one\nOURS\nthree\n'})
+    repository.checkout('feat')
+    theirs = commit_files(repository, 'theirs', {'a.txt': 'one\nTHEIRS\nthree\n'})
+    repository.checkout('master')
+    assert repository.merge('feat') == wit.MergeResult(None, ['a.txt'])
+    assert read(repository, 'a.txt') == 'one\n<<<<<<< HEAD\nOURS\n=======\nTHEIRS\n>>>>>>> feat\nthree\n'
+    assert (repository.main_backup_dir / 'MERGE_HEAD').read_text().strip() == theirs.id
+    resolved = commit_files(repository, 'resolved', {'a.txt': 'one\nBOTH\nthree\n'})
+    assert resolved.parents == (ours.id, theirs.id)
+    assert not (repository.main_backup_dir / 'MERGE_HEAD').exists()
+
+
+def test_merge_fast_forwards_to_a_descendant(repository):
+    base = commit_files(repository, 'base', {'a.txt': 'a\n'})
+    repository.branch('feat')
+    repository.checkout('feat')
+    ahead = commit_files(repository, 'ahead', {'a.txt': 'b\n', 'dir/c.txt': 'c\n'})
+    repository.checkout('master')
+    assert read(repository, 'a.txt') == 'a\n'
+    assert repository.merge('feat') == wit.MergeResult(ahead.id, [])
+    assert [commit.id for commit in repository.log()] == [ahead.id, base.id]
+    assert read(repository, 'a.txt') == 'b\n'
+    assert read(repository, 'dir/c.txt') == 'c\n'
+
+
+def test_fast_forward_refuses_to_overwrite_ignored_files(repository):
+    base = commit_files(repository, 'base', {'.witignore': '*.log\n'})
+    repository.branch('feat')
+    repository.checkout('feat')
+    write(repository, 'secret.log', 'theirs\n')
+    repository.add('secret.log')
+    commit_files(repository, 'ahead', {'a.txt': 'a\n'})
+    repository.checkout('master')
+    write(repository, 'secret.log', 'local\n')
+    with pytest.raises(wit.WitError, match='secret.log'):
+        repository.merge('feat')
+    assert read(repository, 'secret.log') == 'local\n'
+    assert not (repository.root / 'a.txt').exists()
+    assert repository.status().head == base.id
+    assert wit.read_ref(repository.main_backup_dir, 'refs/heads/master') == base.id
+
+
+def test_checkout_across_file_and_directory_swaps(repository):
+    as_file = commit_files(repository, 'file', {'x': 'file\n'})
+    (repository.root / 'x').unlink()
+    as_directory = commit_files(repository, 'directory', {'x/y': 'nested\n'})
+    for commit, expected in [(as_file, 'file\n'), (as_directory, None), (as_file, 'file\n')]:
+        repository.checkout(commit.id)
+        if expected is None:
+            assert read(repository, 'x/y') == 'nested\n'
+        else:
+            assert read(repository, 'x') == expected
+        status = repository.status()
+        assert status.staged == status.unstaged == wit.Changes([], [], [])
+        assert status.untracked == []
+
+
+def test_checkout_refuses_to_overwrite_untracked_files(repository):
+    first = commit_files(repository, 'one', {'.witignore': '*.log\n'})
+    write(repository, 'secret.log', 'tracked\n')
+    repository.add('secret.log')
+    commit_files(repository, 'two', {'d/x': 'x\n', 'f': 'f\n', 'g.txt': 'g\n'})
+    repository.checkout(first.id)
+    write(repository, 'secret.log', 'local\n')
+    write(repository, 'd', 'untracked\n')
+    write(repository, 'f/y', 'untracked\n')
+    with pytest.raises(wit.WitError, match='d, f, secret.log'):
+        repository.checkout('master')
+    assert read(repository, 'secret.log') == 'local\n'
+    assert read(repository, 'd') == 'untracked\n'
+    assert not (repository.root / 'g.txt').exists()
+    assert repository.status().head == first.id
+    for path in ('secret.log', 'd', 'f/y'):
+        (repository.root / path).unlink()
+    (repository.root / 'f').rmdir()
+    repository.checkout('master')
+    assert read(repository, 'd/x') == 'x\n'
+
+
+@pytest.mark.parametrize('path, is_directory, ignored', [
+    ('debug.log', False, True),
+    ('deep/dir/debug.log', False, True),
+    ('keep.log', False, False),
+    ('build', True, True),
+    ('build', False, False),
+    ('src/build', True, True),
+    ('root_only', False, True),
+    ('sub/root_only', False, False),
+    ('docs/a/b/x.tmp', False, True),
+    ('docs/x.tmp', False, True),
+    ('x.tmp', False, False),
+    ('#hash', False, True),
+    ('abc', False, True),
+    ('a/c', False, False),
+    ('trailing', False, True),
+])
+def test_ignore_matcher_semantics(path, is_directory, ignored):
+    matcher = wit.IgnoreMatcher(['# comment\n', '*.log\n', '!keep.log\n', 'build/\n', '/root_only\n',
+                                 'docs/**/*.tmp\n', '\\#hash\n', 'a?c\n', 'trailing   \n'])
+    assert matcher.is_ignored(path, is_directory) == ignored
+
+
+def test_witignore_in_status_and_add(repository):
+    commit_files(repository, 'tracked', {'tracked.log': 'tracked\n'})
+    write(repository, '.witignore', 'node_modules/\n*.log\n')
+    write(repository, 'node_modules/package/index.js', 'js\n')
+    write(repository, 'debug.log', 'debug\n')
+    write(repository, 'src/main.py', 'main\n')
+    write(repository, 'tracked.log', 'changed\n')
+    status = repository.status()
+    assert status.untracked == ['.witignore', 'src/main.py']
+    assert status.unstaged.modified == ['tracked.log']
+    repository.add('.')
+    index = wit.read_index(repository.main_backup_dir)
+    assert sorted(index) == ['.witignore', 'src/main.py', 'tracked.log']
+
+
+def test_diff_before_the_first_commit(repository):
+    write(repository, 'a.txt', 'one\n')
+    repository.add('a.txt')
+    for cached, old in ((True, None), (False, 'HEAD')):
+        assert ''.join(repository.diff(old, cached=cached)) == \
+            'diff --wit a/a.txt b/a.txt\nnew file\n--- /dev/null\n+++ b/a.txt\n@@ -0,0 +1 @@\n+one\n'
+    assert list(repository.diff('HEAD', 'HEAD')) == []
+
+
+def test_myers_diff_gives_up_on_rewrites_at_once(monkeypatch):
+    old = [f'line {number}\n' for number in range(1000)]
+    new = [f'new {number}\n' for number in range(1000)]
+    assert wit.myers_diff(old, new) is None
+    assert wit.diff_opcodes(old, new) == [('replace', 0, 1000, 0, 1000)]
+    monkeypatch.setattr(wit, 'DIFF_MAX_EDITS', 4)
+    assert wit.myers_diff(['a', 'b', 'c'], ['c', 'b', 'a']) == [
+        ('delete', 0, 0), ('delete', 1, 0), ('equal', 2, 0), ('insert', 3, 1), ('insert', 3, 2)]
+    assert wit.myers_diff(['a', 'b', 'c', 'd'], ['d', 'c', 'b', 'a']) is None
+
+
+def test_diff_opcodes_rebuild_the_new_lines():
+    generator = random.Random(7)
+    for _ in range(200):
+        old = [generator.choice('abcde') for _ in range(generator.randrange(30))]
+        new = [generator.choice('abcde') for _ in range(generator.randrange(30))]
+        rebuilt = []
+        for tag, old_start, old_end, new_start, new_end in wit.diff_opcodes(old, new):
+            if tag == 'equal':
+                assert old[old_start:old_end] == new[new_start:new_end]
+            rebuilt.extend(new[new_start:new_end])
+        assert rebuilt == new
+
+
+def test_gc_keeps_history_readable(repository):
+    commits = [commit_files(repository, f'c{number}', {'a.txt': f'{number}\n' * 50 + 'shared\n' * 200,
+                                                     f'f{number}.txt': f'{number}\n'})
+               for number in range(5)]
+    repository.branch('old')
+    wit.gc(repository)
+    assert not wit.list_loose_objects(repository.main_backup_dir)
+    assert not (repository.main_backup_dir / 'refs' / 'heads' / 'old').exists()
+    assert repository.checkout('old') == commits[-1]
+    repository.checkout(commits[1].id)
+    assert read(repository, 'a.txt') == '1\n' * 50 + 'shared\n' * 200
+    assert not (repository.root / 'f3.txt').exists()
+
+
+def test_path_limited_log_with_and_without_bloom_filters(repository):
+    first = commit_files(repository, 'one', {'a.txt': 'a\n', 'dir/b.txt': 'b\n'})
+    second = commit_files(repository, 'two', {'dir/b.txt': 'b2\n'})
+    commit_files(repository, 'three', {'c.txt': 'c\n'})
+    fourth = commit_files(repository, 'four', {'a.txt': 'a2\n', 'dir/sub/d.txt': 'd\n'})
+    expected = {'a.txt': [fourth.id, first.id], 'dir': [fourth.id, second.id, first.id],
+                'dir/b.txt': [second.id, first.id], 'missing.txt': []}
+    for path, commit_ids in expected.items():
+        assert [commit.id for commit in repository.log(paths=[path])] == commit_ids
+    (repository.main_backup_dir / 'commit-graph-bloom').unlink()
+    for path, commit_ids in expected.items():
+        assert [commit.id for commit in repository.log(paths=[path])] == commit_ids
+    assert wit.write_bloom_filters(repository) == 4
+    assert [commit.id for commit in repository.log(paths=['a.txt'], limit=1)] == [fourth.id]
+
+
+def test_fsmonitor_matches_a_full_walk(repository, monkeypatch):
+    try:
+        monitor = wit.FSMonitor(repository)
+    except OSError:
+        pytest.skip('inotify is not available')
+    backup_dir = repository.main_backup_dir
+    for directory in range(8):
+        for name in range(8):
+            write(repository, f'd{directory}/f{name}', f'{directory} {name}\n')
+    repository.add('.')
+    repository.commit('one')
+    thread = wit.threading.Thread(target=monitor.run)
+    thread.start()
+    query_fsmonitor = wit.query_fsmonitor
+    walk_working_tree = wit.walk_working_tree
+    walks = []
+    monkeypatch.setattr(wit, 'walk_working_tree', lambda *args: walks.append(args) or walk_working_tree(*args))
+
+    def full_walk():
+        monkeypatch.setattr(wit, 'query_fsmonitor', lambda *args: None)
+        try:
+            return wit.compare_index_to_working_tree(backup_dir, wit.read_index(backup_dir))
+        finally:
+            monkeypatch.setattr(wit, 'query_fsmonitor', query_fsmonitor)
+
+    generator = random.Random(21)
+    comparisons = 0
+    incremental = 0
+    try:
+        while not (backup_dir / wit.FSMONITOR_SOCKET).exists():
+            wit.time.sleep(0.01)
+        for step in range(300):
+            action = generator.random()
+            directory = f'd{generator.randrange(8)}'
+            path = repository.root / directory / f'f{generator.randrange(10)}'
+            try:
+                if action < 0.3:
+                    with open(path, 'a') as file:
+                        file.write('x')
+                elif action < 0.45:
+                    path.unlink()
+                elif action < 0.55:
+                    write(repository, f'{directory}/sub/g', 'g\n')
+                elif action < 0.6:
+                    (repository.root / directory).rename(repository.root / f'moved{directory}')
+                elif action < 0.65:
+                    (repository.root / f'moved{directory}').rename(repository.root / directory)
+                elif action < 0.7:
+                    repository.add()
+                elif action < 0.75:
+                    repository.commit(f'step {step}')
+                elif action < 0.8:
+                    wit.shutil.rmtree(repository.root / directory)
+                elif action < 0.85:
+                    write(repository, '.witignore', generator.choice(['sub/\n', 'f1\n', '']))
+            except (OSError, wit.WitError):
+                pass
+            if generator.random() < 0.5:
+                del walks[:]
+                result = wit.compare_index_to_working_tree(backup_dir, wit.read_index(backup_dir))
+                comparisons += 1
+                incremental += not walks
+                assert result == full_walk(), step
+    finally:
+        wit.fsmonitor(repository, 'stop')
+        thread.join()
+    assert incremental > comparisons // 2
+
+
+def test_batch_answers_each_command_with_a_json_line(repository, monkeypatch, capsys):
+    write(repository, 'a.txt', 'one\n')
+    monkeypatch.setattr(wit, 'pack_refs', lambda repository: print('packing'))
+    commands = io.StringIO('add a.txt\ncommit "first commit"\n\nstatus\nlog\ncheckout nosuch\npack-refs\n'
+                           'diff\nbogus\n')
+    output = io.StringIO()
+    wit.batch(repository, commands, output)
+    responses = [wit.json.loads(line) for line in output.getvalue().splitlines()]
+    assert [response['ok'] for response in responses] == [True, True, True, True, False, True, True, False]
+    commit_id = responses[1]['result']
+    assert responses[2]['result']['Most recent commit id'] == commit_id
+    assert [entry['commit'] for entry in responses[3]['result']] == [commit_id]
+    assert responses[3]['result'][0]['message'] == 'first commit'
+    assert responses[4]['error'] == 'Unknown revision nosuch.'
+    assert responses[6]['result'] == ''
+    assert responses[7]['error'] == 'Unknown command bogus.'
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert 'packing' in captured.err
+
+
+def test_batch_sees_changes_made_between_commands(repository):
+    first = commit_files(repository, 'one', {'a.txt': 'one\n'})
+    seen = []
+
+    def commands():
+        yield 'status\n'
+        seen.append(commit_files(wit.Repository.open(), 'two', {'a.txt': 'two\n'}))
+        yield 'status\n'
+        yield 'log\n'
+
+    output = io.StringIO()
+    wit.batch(repository, commands(), output)
+    responses = [wit.json.loads(line) for line in output.getvalue().splitlines()]
+    assert responses[0]['result']['Most recent commit id'] == first.id
+    assert responses[1]['result']['Most recent commit id'] == seen[0].id
+    assert [entry['commit'] for entry in responses[2]['result']] == [seen[0].id, first.id]
+
+
+def test_tracer_records_nested_spans_and_counters(repository, tmp_path_factory, monkeypatch):
+    trace_path = tmp_path_factory.mktemp('trace') / 'trace.json'
+    monkeypatch.setattr(wit, 'TRACER', wit.Tracer(trace_path))
+    write(repository, 'a.txt', 'a' * 5000)
+    with wit.trace_span('wit add', argv=['a.txt']):
+        repository.add('a.txt')
+    wit.TRACER.write()
+    events = wit.json.loads(trace_path.read_text())['traceEvents']
+    spans = {event['name']: event for event in events}
+    assert {'wit add', 'add', 'store_blob', 'Transaction.commit'} <= set(spans)
+    outer, store = spans['wit add'], spans['store_blob']
+    assert outer['args']['argv'] == ['a.txt']
+    assert outer['ts'] <= store['ts'] and store['ts'] + store['dur'] <= outer['ts'] + outer['dur']
+    assert store['args']['files_hashed'] == 1
+    assert store['args']['bytes_copied'] == 5000
+    if wit.os.path.exists(wit.TRACE_IO):
+        assert outer['args']['wchar'] >= 5000
+        assert all(outer['args'][field] >= store['args'][field] >= 0 for field in wit.TRACE_IO_FIELDS)
+
+
+def test_trace_option_and_environment_variable(repository, tmp_path_factory):
+    trace_dir = tmp_path_factory.mktemp('trace')
+    command = [sys.executable, str(pathlib.Path(wit.__file__)), '--trace', str(trace_dir / 'option.json'), 'status']
+    environment = dict(wit.os.environ, WIT_TRACE=str(trace_dir / 'environment.json'))
+    subprocess.run(command, cwd=repository.root, check=True, capture_output=True)
+    subprocess.run(command[:2] + ['status'], cwd=repository.root, env=environment, check=True,
+                       capture_output=True)
+    for name in ('option.json', 'environment.json'):
+        names = [event['name'] for event in wit.json.loads((trace_dir / name).read_text())['traceEvents']]
+        assert 'wit status' in names
+        assert 'read_status' in names
+
+
+def test_discovery_with_wit_dir_and_ceiling_directories(repository, tmp_path_factory, monkeypatch):
+    root = repository.root
+    (root / 'a' / 'b').mkdir(parents=True)
+    assert wit.Repository.discover(root / 'a' / 'b').root == root
+    monkeypatch.setenv('WIT_CEILING_DIRECTORIES', f'{tmp_path_factory.mktemp("other")}{wit.os.pathsep}{root}')
+    with pytest.raises(FileNotFoundError, match='No backup folder found'):
+        wit.Repository.discover(root / 'a' / 'b')
+    assert wit.Repository.discover(root).root == root
+    monkeypatch.setenv('WIT_DIR', str(repository.main_backup_dir))
+    monkeypatch.chdir(tmp_path_factory.mktemp('elsewhere'))
+    assert wit.Repository.open().main_backup_dir == repository.main_backup_dir
+    monkeypatch.setenv('WIT_DIR', str(root / 'missing'))
+    with pytest.raises(FileNotFoundError, match='is not a directory'):
+        wit.Repository.open()